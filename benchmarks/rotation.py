@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""
+Measure how long a wallpaper rotation takes, from the API request to the wallpapers being set.
+
+A local HTTP server stands in for the Konachan post.json and e621 posts.json endpoints and serves
+synthetic images of a chosen size after a chosen delay; wallpapers are "set" with the null environment,
+which composites the images like a real setter and then only records the call. Each combination of
+source, monitor count and image size runs in a fresh process with an empty cache, driving the real
+source handler and rotation pipeline, timing the API, download, decode/composite and set stages from
+the metrics spans they write and recording the peak RSS. Results are written as JSON; given a baseline
+from an earlier run, it exits with status 1 if anything regressed.
+
+    python benchmarks/rotation.py --output rotation.json
+    python benchmarks/rotation.py --monitors 1,8 --image-sizes 7680x4320 --baseline rotation.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The child processes import konawall from this checkout rather than from whatever is installed
+sys.path.insert(0, REPOSITORY)
+
+# Stages timed for every rotation, in the order they run
+STAGES = ["api_s", "download_s", "composite_s", "set_s", "total_s"]
+PREVIEW_SIZE = (150, 84)
+
+"""
+Make a JPEG that costs about as much to decode as a real wallpaper of the same size
+
+:param width: The width of the image
+:param height: The height of the image
+:returns: The encoded image
+"""
+def synthetic_image(width: int, height: int) -> bytes:
+    from PIL import Image
+    # Noise over a gradient, so the encoder cannot make it unrealistically small
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 48)
+    image = Image.merge("RGB", [gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)])
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+"""
+Imitates just enough of the Konachan and e621 APIs for konawall to fetch posts and images from it
+"""
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, image_size: tuple, api_latency: float, image_latency: float):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.image_size = image_size
+        self.api_latency = api_latency
+        self.image_latency = image_latency
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.images = {
+            "images": synthetic_image(*image_size),
+            "previews": synthetic_image(*PREVIEW_SIZE),
+        }
+        # Hashing the shared part once keeps the API stand-in from being slowed down by hashing whole images
+        self.image_hashes = {kind: hashlib.md5(image) for kind, image in self.images.items()}
+        self.next_id = 1
+        self.id_lock = threading.Lock()
+
+    # Every post gets different bytes, and so a different MD5, by trailing data decoders ignore
+    def image_bytes(self, kind: str, post_id: int) -> bytes:
+        return self.images[kind] + self.image_suffix(post_id)
+
+    def image_suffix(self, post_id: int) -> bytes:
+        return f"konawall-benchmark {post_id}".encode()
+
+    def image_md5(self, kind: str, post_id: int) -> str:
+        image_hash = self.image_hashes[kind].copy()
+        image_hash.update(self.image_suffix(post_id))
+        return image_hash.hexdigest()
+
+    def new_ids(self, count: int) -> range:
+        with self.id_lock:
+            start = self.next_id
+            self.next_id += count
+        return range(start, start + count)
+
+    def konachan_post(self, post_id: int) -> dict:
+        width, height = self.image_size
+        return {
+            "id": post_id,
+            "author": "benchmark",
+            "rating": "s",
+            "tags": "benchmark",
+            "md5": self.image_md5("images", post_id),
+            "width": width,
+            "height": height,
+            "file_url": f"{self.base_url}/images/{post_id}.jpg",
+            "preview_url": f"{self.base_url}/previews/{post_id}.jpg",
+            "actual_preview_width": PREVIEW_SIZE[0],
+            "actual_preview_height": PREVIEW_SIZE[1],
+            "sample_url": None,
+            "sample_width": None,
+            "sample_height": None,
+            "jpeg_url": None,
+            "jpeg_width": None,
+            "jpeg_height": None,
+        }
+
+    def e621_post(self, post_id: int) -> dict:
+        width, height = self.image_size
+        return {
+            "id": post_id,
+            "uploader_id": 0,
+            "rating": "s",
+            "tags": {"general": ["benchmark"]},
+            "file": {
+                "url": f"{self.base_url}/images/{post_id}.jpg",
+                "width": width,
+                "height": height,
+                "md5": self.image_md5("images", post_id),
+            },
+            "preview": {
+                "url": f"{self.base_url}/previews/{post_id}.jpg",
+                "width": PREVIEW_SIZE[0],
+                "height": PREVIEW_SIZE[1],
+            },
+            "sample": {"has": False, "url": None, "width": None, "height": None},
+        }
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parsed = urlsplit(self.path)
+        query = parse_qs(parsed.query)
+        if parsed.path in ["/post.json", "/posts.json"]:
+            time.sleep(self.server.api_latency)
+            ids = self.server.new_ids(int(query.get("limit", ["100"])[0]))
+            if parsed.path == "/post.json":
+                body = json.dumps([self.server.konachan_post(post_id) for post_id in ids])
+            else:
+                body = json.dumps({"posts": [self.server.e621_post(post_id) for post_id in ids]})
+            self.send_body(body.encode(), "application/json")
+            return
+        kind, _, name = parsed.path.strip("/").partition("/")
+        if kind in self.server.images and name.endswith(".jpg") and name[:-4].isdigit():
+            time.sleep(self.server.image_latency)
+            self.send_body(self.server.image_bytes(kind, int(name[:-4])), "image/jpeg")
+            return
+        self.send_error(404)
+
+    def send_body(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Keep the request log out of the results
+    def log_message(self, format, *args):
+        pass
+
+"""
+Work out how long each stage of a rotation took from the metrics it wrote
+
+:param records: The metrics records of one rotation, see konawall.metrics
+:param composite: How the images were composited, which decides the span it is timed by
+:returns: The time spent in each stage but the total, and the bytes downloaded
+"""
+def stage_times(records: list, composite: str) -> dict:
+    durations = lambda name: sum(record["duration_s"] for record in records if record["name"] == name)
+    # combine_to_viewport renders each display itself, so only the outermost span is counted
+    composite_s = durations("combine_to_viewport" if composite == "viewport" else "render_for_displays")
+    return {
+        "api_s": durations("request_posts"),
+        "download_s": durations("download_files"),
+        "composite_s": composite_s,
+        # The null setter composites before recording the call, as the real setters do
+        "set_s": durations("null_setter") - composite_s,
+        "bytes_downloaded": sum(record.get("bytes", 0) for record in records if record["name"] == "download"),
+    }
+
+"""
+Time rotations for one scenario; runs in a child process of its own, so that peak RSS is its own
+
+Every rotation goes through the registered source handler and konawall.pipeline.rotate, exactly as
+the tray application runs them, and the stages are timed by the metrics spans they write.
+
+:param scenario: The source, monitor count, display size, base URL and number of runs
+:returns: The timings of every run, and the peak RSS in KiB
+"""
+def run_scenario(scenario: dict) -> dict:
+    import asyncio
+    from screeninfo import Monitor
+    from konawall import metrics, pool
+    from konawall.module_loader import import_dir
+    from konawall.pipeline import rotate
+    import konawall.environments.null as null_environment
+
+    package = os.path.join(REPOSITORY, "konawall")
+    import_dir(os.path.join(package, "sources"))
+    import_dir(os.path.join(package, "environments"))
+    width, height = scenario["display_size"]
+    displays = [Monitor(x=i * width, y=0, width=width, height=height) for i in range(scenario["monitors"])]
+    runs = []
+    for _ in range(scenario["runs"]):
+        # A cold cache and an empty post pool every time, so every stage does its full work
+        pool.pools.clear()
+        with tempfile.TemporaryDirectory(prefix="konawall-benchmark-") as cache_dir:
+            config = {
+                "cache_dir": cache_dir,
+                "konachan_url": scenario["base_url"],
+                "e621_url": scenario["base_url"],
+                "e621_api_key": "",
+                "compositor": {"fit": scenario["fit"]},
+                "null": {"composite": scenario["composite"]},
+                "metrics": {"enabled": True},
+            }
+            metrics.configure(config)
+            start = time.perf_counter()
+            asyncio.run(rotate(scenario["source"], "null", displays, ["benchmark"], config))
+            finished = time.perf_counter()
+            metrics_path = os.path.join(cache_dir, "metrics.jsonl")
+            with open(metrics_path, "r", encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+            run = stage_times(records, scenario["composite"])
+            run["total_s"] = finished - start
+            runs.append(run)
+    if len(null_environment.calls) != scenario["runs"]:
+        raise RuntimeError(f"Expected {scenario['runs']} calls to the null setter, got {len(null_environment.calls)}")
+    try:
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes
+        if sys.platform == "darwin":
+            peak_rss //= 1024
+    except ImportError:
+        peak_rss = None
+    return {"runs": runs, "peak_rss_kib": peak_rss}
+
+"""
+Run one scenario in a fresh interpreter
+
+:param scenario: The scenario, see run_scenario
+:returns: What run_scenario returned
+"""
+def run_child(scenario: dict) -> dict:
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", json.dumps(scenario)],
+        cwd=REPOSITORY,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Scenario {scenario} failed:\n{result.stderr}")
+    return json.loads(result.stdout)
+
+"""
+Parse a list of sizes like "1920x1080,3840x2160"
+
+:param value: The list of sizes
+:returns: A list of (width, height) tuples
+"""
+def parse_sizes(value: str) -> list:
+    return [tuple(int(part) for part in size.split("x")) for size in value.split(",")]
+
+"""
+Compare results against a baseline
+
+:param results: The results of this run
+:param baseline: The results of an earlier run
+:param tolerance: How much slower or larger, as a fraction, counts as a regression
+:returns: A list of descriptions of what regressed
+"""
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    scenario_key = lambda entry: (entry["source"], entry["monitors"], tuple(entry["image_size"]))
+    earlier = {scenario_key(entry): entry for entry in baseline.get("results", [])}
+    found = []
+    for entry in results["results"]:
+        match = earlier.get(scenario_key(entry))
+        if match is None:
+            continue
+        for key in STAGES + ["peak_rss_kib"]:
+            if entry.get(key) is not None and match.get(key) is not None and entry[key] > match[key] * (1 + tolerance):
+                found.append(f"{key} for {scenario_key(entry)}: {entry[key]} against a baseline of {match[key]}")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure konawall's rotation time against a local stand-in API")
+    parser.add_argument("-r", "--runs", help="number of rotations to take the median of", type=int, default=3)
+    parser.add_argument("-m", "--monitors", help="comma separated monitor counts", type=str, default="1,2,4,8")
+    parser.add_argument("-i", "--image-sizes", help="comma separated sizes of the images served", type=str, default="1920x1080,3840x2160")
+    parser.add_argument("-d", "--display-size", help="size of every monitor", type=str, default="1920x1080")
+    parser.add_argument("-s", "--sources", help="comma separated sources to imitate", type=str, default="konachan,e621")
+    parser.add_argument("--composite", help="render per display, or combine into one viewport image", choices=["renditions", "viewport"], default="renditions")
+    parser.add_argument("--fit", help="how images are sized to the displays", choices=["stretch", "fill", "fit"], default="stretch")
+    parser.add_argument("--api-latency", help="milliseconds before the API answers", type=float, default=50)
+    parser.add_argument("--image-latency", help="milliseconds before an image starts downloading", type=float, default=20)
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file", type=str)
+    parser.add_argument("-b", "--baseline", help="compare against results from an earlier run", type=str)
+    parser.add_argument("-t", "--tolerance", help="allowed slowdown against the baseline, as a fraction", type=float, default=0.2)
+    parser.add_argument("--child", help=argparse.SUPPRESS, type=str)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(json.loads(args.child))))
+        return
+
+    display_size = parse_sizes(args.display_size)[0]
+    results = {
+        "python": sys.version.split()[0],
+        "parameters": {
+            "runs": args.runs,
+            "display_size": display_size,
+            "composite": args.composite,
+            "fit": args.fit,
+            "api_latency_ms": args.api_latency,
+            "image_latency_ms": args.image_latency,
+        },
+        "results": [],
+    }
+    for image_size in parse_sizes(args.image_sizes):
+        server = StandInServer(image_size, args.api_latency / 1000, args.image_latency / 1000)
+        threading.Thread(target=server.serve_forever, name="stand-in-api", daemon=True).start()
+        try:
+            for source in args.sources.split(","):
+                for monitors in [int(count) for count in args.monitors.split(",")]:
+                    scenario = {
+                        "source": source,
+                        "monitors": monitors,
+                        "display_size": display_size,
+                        "base_url": server.base_url,
+                        "runs": args.runs,
+                        "composite": args.composite,
+                        "fit": args.fit,
+                    }
+                    outcome = run_child(scenario)
+                    entry = {
+                        "source": source,
+                        "monitors": monitors,
+                        "image_size": image_size,
+                        "peak_rss_kib": outcome["peak_rss_kib"],
+                        "bytes_downloaded": statistics.median(run["bytes_downloaded"] for run in outcome["runs"]),
+                    }
+                    for stage in STAGES:
+                        entry[stage] = statistics.median(run[stage] for run in outcome["runs"])
+                    print(f"{source} {monitors} monitor(s) {image_size[0]}x{image_size[1]}: {entry['total_s']:.3f}s", file=sys.stderr)
+                    results["results"].append(entry)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f"Regression in {regression}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Measure how long konawall takes to start.
+
+Records the import time of konawall.gui with -X importtime, and the time from launching the tray
+application until it handles its first event and finishes starting up. The application knows it is
+being measured, and skips its first rotation and the missing config dialog, so nothing is fetched,
+no wallpaper changes and nothing waits for a click. Results are written as JSON; given a baseline
+from an earlier run, it exits with status 1 if anything regressed.
+
+    python benchmarks/startup.py --output startup.json
+    python benchmarks/startup.py --baseline startup.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+import subprocess
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+"""
+Import a module in a fresh interpreter with -X importtime
+
+:param module: The module to import
+:returns: A tuple of the total import time in microseconds, and the slowest imports as (module, microseconds) pairs
+"""
+def import_time(module: str) -> tuple:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPOSITORY,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = []
+    total = 0
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_time, cumulative, name = [part.strip() for part in line.replace("import time:", "|", 1).split("|")]
+        imports.append((name, int(self_time)))
+        if name == module:
+            total = int(cumulative)
+    imports.sort(key=lambda entry: entry[1], reverse=True)
+    return total, imports[:15]
+
+"""
+Launch the tray application and time it until it reports its first event and the end of its start up
+
+:param timeout: How many seconds to wait before giving up
+:returns: A tuple of (seconds to first event, seconds to startup finished)
+"""
+def time_to_first_event(timeout: float) -> tuple:
+    environment = dict(os.environ, KONAWALL_STARTUP_BENCHMARK="1")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "konawall.gui"],
+        cwd=REPOSITORY,
+        env=environment,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    # Reading the output blocks, so a timer takes care of an application that never gets going
+    watchdog = threading.Timer(timeout, process.kill)
+    watchdog.start()
+    first_event = None
+    startup_finished = None
+    try:
+        for line in process.stdout:
+            if "konawall-benchmark: first-event" in line:
+                first_event = time.perf_counter() - start
+            elif "konawall-benchmark: startup-finished" in line:
+                startup_finished = time.perf_counter() - start
+                break
+    finally:
+        watchdog.cancel()
+        process.kill()
+        process.wait()
+    if first_event is None or startup_finished is None:
+        raise RuntimeError("konawall did not report its start up; is a display available?")
+    return first_event, startup_finished
+
+"""
+Compare results against a baseline
+
+:param results: The results of this run
+:param baseline: The results of an earlier run
+:param tolerance: How much slower, as a fraction, counts as a regression
+:returns: A list of descriptions of what regressed
+"""
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    found = []
+    for key in ["import_time_us", "first_event_s", "startup_finished_s"]:
+        if key in results and key in baseline and results[key] > baseline[key] * (1 + tolerance):
+            found.append(f"{key}: {results[key]} against a baseline of {baseline[key]}")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure konawall's start up time")
+    parser.add_argument("-r", "--runs", help="number of runs to take the median of", type=int, default=5)
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file", type=str)
+    parser.add_argument("-b", "--baseline", help="compare against results from an earlier run", type=str)
+    parser.add_argument("-t", "--tolerance", help="allowed slowdown against the baseline, as a fraction", type=float, default=0.2)
+    parser.add_argument("--no-gui", help="only measure import time, for machines without a display", action="store_true")
+    parser.add_argument("--timeout", help="seconds to wait for the application to start", type=float, default=60)
+    args = parser.parse_args()
+
+    import_times = []
+    for _ in range(args.runs):
+        total, slowest = import_time("konawall.gui")
+        import_times.append(total)
+    results = {
+        "python": sys.version.split()[0],
+        "import_time_us": statistics.median(import_times),
+        "slowest_imports": slowest,
+    }
+    if not args.no_gui:
+        first_events = []
+        startups = []
+        for _ in range(args.runs):
+            first_event, startup_finished = time_to_first_event(args.timeout)
+            first_events.append(first_event)
+            startups.append(startup_finished)
+        results["first_event_s"] = statistics.median(first_events)
+        results["startup_finished_s"] = statistics.median(startups)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f"Regression in {regression}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import time
+import hashlib
+import logging
+import tempfile
+from urllib.parse import urlparse
+from konawall.custom_print import kv_print
+
+# Partially downloaded files carry this suffix until they are complete
+PART_SUFFIX = ".part"
+
+"""
+Find the directory konawall keeps its cache in
+
+:param config: The configuration, which may override the location with cache_dir
+:returns: The path to the cache directory, which is created if missing
+"""
+def cache_dir(config: dict = {}) -> str:
+    if "cache_dir" in config:
+        path = os.path.expanduser(config["cache_dir"])
+    else:
+        try:
+            from xdg_base_dirs import xdg_cache_home
+            path = os.path.join(xdg_cache_home(), "konawall")
+        except:
+            path = os.path.join(os.path.expanduser("~"), ".cache", "konawall")
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    return path
+
+"""
+Find a named subdirectory of the cache
+
+:param name: The name of the subdirectory
+:param config: The configuration
+:returns: The path to the subdirectory, which is created if missing
+"""
+def cache_subdir(name: str, config: dict = {}) -> str:
+    path = os.path.join(cache_dir(config), name)
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    return path
+
+"""
+Work out the cache file name for an image
+
+:param url: The URL the image is downloaded from
+:param checksum: The MD5 checksum of the image, if known
+:returns: The file name the image is cached under
+"""
+def image_key(url: str, checksum: str = None) -> str:
+    # Content-addressed where we can be, otherwise fall back to hashing the URL
+    key = checksum.lower() if checksum else hashlib.md5(url.encode("utf-8")).hexdigest()
+    # Keep the extension around for setters that sniff the file type from the name
+    _, extension = os.path.splitext(urlparse(url).path)
+    return key + extension.lower()
+
+"""
+Look an image up in the cache, marking it as recently used
+
+:param key: The cache file name of the image
+:param config: The configuration
+:returns: The path to the cached image, or None if it is not cached
+"""
+def lookup(key: str, config: dict = {}) -> str:
+    path = os.path.join(cache_subdir("images", config), key)
+    if not os.path.isfile(path):
+        return None
+    # The modification time doubles as the last-used time for eviction
+    os.utime(path)
+    return path
+
+"""
+Create a file to download an image into, on the same filesystem as the cache
+
+:param config: The configuration
+:returns: An open temporary file
+"""
+def new_part_file(config: dict = {}):
+    return tempfile.NamedTemporaryFile(dir=cache_subdir("images", config), suffix=PART_SUFFIX, delete=False)
+
+"""
+Move a completed download into the cache
+
+:param part_path: The path to the completed temporary file
+:param key: The cache file name of the image
+:param config: The configuration
+:returns: The path to the cached image
+"""
+def store(part_path: str, key: str, config: dict = {}) -> str:
+    path = os.path.join(cache_subdir("images", config), key)
+    os.replace(part_path, path)
+    return path
+
+"""
+Remove the least recently used files from a cache subdirectory until it fits the byte budget
+
+:param name: The name of the cache subdirectory
+:param config: The configuration, used for cache_max_bytes
+:param keep: Paths that are in use and must not be evicted
+:param max_bytes: The byte budget, if it is not cache_max_bytes
+"""
+def evict(name: str = "images", config: dict = {}, keep: list = [], max_bytes: int = None):
+    if max_bytes is None:
+        max_bytes = config.get("cache_max_bytes", 1024 * 1024 * 1024)
+    path = cache_subdir(name, config)
+    entries = []
+    total = 0
+    with os.scandir(path) as scan:
+        for entry in scan:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            total += stat.st_size
+            # Files in use count towards the budget, but are never candidates for removal
+            if entry.path in keep:
+                continue
+            # Leave downloads in progress alone unless they were abandoned a long time ago
+            if entry.name.endswith(PART_SUFFIX) and time.time() - stat.st_mtime < 60 * 60:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    if total <= max_bytes:
+        return
+    # Oldest first
+    entries.sort()
+    for _, size, file in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(file)
+            total -= size
+            logging.debug(f"Evicted {file} from the cache")
+        except FileNotFoundError:
+            pass
+    kv_print(f"Cache {name} size after eviction", total, level="debug")
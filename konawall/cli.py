@@ -3,11 +3,12 @@
 import os
 import sys
 import logging
+import asyncio
 import argparse
-import screeninfo
-from environment import set_environment_wallpapers, detect_environment
-from module_loader import import_dir, environment_handlers, source_handlers
-from imager import combine_to_viewport
+from konawall.displays import get_displays
+from konawall.environment import detect_environment
+from konawall.module_loader import import_dir, environment_handlers, source_handlers
+from konawall.pipeline import rotate
 
 def main():
     parser = argparse.ArgumentParser(
@@ -41,27 +42,21 @@ def main():
     logging.debug(f"Called with args={args}")
 
     import_dir(os.path.join(os.path.dirname(os.path.abspath( __file__ )), "sources"))
-    logging.debug(f"Loaded source handlers: {', '.join(source_handlers)}")
+    logging.debug(f"Found source handlers: {', '.join(source_handlers)}")
     import_dir(os.path.join(os.path.dirname(os.path.abspath( __file__ )), "environments"))
-    logging.debug(f"Loaded environment handlers: {', '.join(environment_handlers)}")
+    logging.debug(f"Found environment handlers: {', '.join(environment_handlers)}")
 
     environment = detect_environment()
-    environment_handlers[environment + "_init"]()
+    if f"{environment}_init" in environment_handlers:
+        environment_handlers[f"{environment}_init"]()
 
-    displays = screeninfo.get_monitors()
+    displays = get_displays()
     if not args.count:
         count = len(displays)
     else:
         count = args.count
 
-    files, posts = source_handlers[args.source](count, args.tags)
-
-    if not args.environment:
-        set_environment_wallpapers(environment, files, displays)
-    else:
-        environment_handlers[f"{args.environment}_setter"](files, displays)
-        logging.debug("Wallpapers set!")
-
+    asyncio.run(rotate(args.source, args.environment or environment, displays, args.tags, {}, count=count))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
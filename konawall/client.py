@@ -0,0 +1,204 @@
+import time
+import random
+import logging
+import threading
+import email.utils
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from konawall.custom_errors import RequestFailed
+
+DEFAULT_USER_AGENT = "konachan-py/alpha"
+# Settings for hosts with limits of their own, which [http.hosts] in the config can override;
+# hosts not listed here, like the image servers, are not rate limited unless the config says so
+HOST_DEFAULTS = {
+    "konachan.com": {"rate": 2, "burst": 4},
+    # e621 has a hard limit of two requests a second, and asks for one a second sustained
+    "e621.net": {"rate": 1, "burst": 2, "user_agent": "konachan-py/alpha (by katsmew on e621)"},
+}
+# Responses worth trying again after a while, rather than failing straight away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# One session for everything, so connections to a host are kept alive between requests
+global session
+session = None
+# One token bucket per host
+buckets = {}
+client_lock = threading.Lock()
+
+"""
+Hands out requests for one host at a steady rate, with room for a short burst
+"""
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    # Wait until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    # Hold back every request to the host for a while, when it has asked us to slow down
+    def block(self, seconds: float):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+"""
+Work out the settings for a host, from the built-in defaults and the [http] table of the config
+
+:param host: The host name
+:param config: The configuration
+:returns: A dict with user_agent, rate, burst, timeout, retries and max_backoff
+"""
+def host_settings(host: str, config: dict = {}) -> dict:
+    http_config = config.get("http", {})
+    settings = {
+        "user_agent": http_config.get("user_agent", DEFAULT_USER_AGENT),
+        "rate": http_config.get("rate"),
+        "burst": http_config.get("burst", 1),
+        "timeout": http_config.get("timeout", 30),
+        "retries": http_config.get("retries", 4),
+        "max_backoff": http_config.get("max_backoff", 60),
+    }
+    settings.update(HOST_DEFAULTS.get(host, {}))
+    settings.update(http_config.get("hosts", {}).get(host, {}))
+    return settings
+
+"""
+Get the shared session, creating it on first use
+
+:returns: The session
+"""
+def get_session() -> requests.Session:
+    global session
+    with client_lock:
+        if session is None:
+            session = requests.Session()
+            # Enough kept-alive connections per host for the downloads and pool refills running at once
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        return session
+
+"""
+Get the token bucket for a host, or None if the host is not rate limited
+
+:param host: The host name
+:param settings: The host's settings, see host_settings
+:returns: The bucket
+"""
+def bucket_for(host: str, settings: dict):
+    if not settings["rate"]:
+        return None
+    with client_lock:
+        bucket = buckets.get(host)
+        # A reloaded config may have changed the limits
+        if bucket is None or (bucket.rate, bucket.burst) != (settings["rate"], settings["burst"]):
+            bucket = buckets[host] = TokenBucket(settings["rate"], max(1, settings["burst"]))
+        return bucket
+
+"""
+Read how long a server asked us to wait from a Retry-After header
+
+:param response: The response
+:returns: The number of seconds, or None if the header is missing or unreadable
+"""
+def retry_after(response) -> float:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        # The header may also be an HTTP date
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+"""
+Count the bytes a response's body took on the wire, before its Content-Encoding was undone
+
+:param response: The response, with its body already read
+:returns: The number of bytes, or None if they cannot be told, as with chunked responses
+"""
+def transferred_bytes(response) -> int:
+    length = response.headers.get("Content-Length", "")
+    if length.strip().isdigit():
+        return int(length)
+    # urllib3 counts what it reads of a body without a length, though not of a chunked one
+    counted = response.raw.tell() if response.raw is not None else 0
+    return counted or None
+
+"""
+Send a GET request through the shared session, keeping to the host's rate limit and backing off
+when the server is overloaded or asks us to slow down
+
+Streaming requests are not retried after connection errors, since the caller can resume them
+from where they stopped, see konawall.downloader.
+
+:param url: The URL to request
+:param config: The configuration, used for the [http] table
+:param headers: Extra headers to send
+:param stream: Whether to leave the body to be read by the caller
+:param timeout: The connect and read timeout in seconds, if not the host's
+:returns: The response, which may still be an error if retrying did not help
+"""
+def get(url: str, config: dict = {}, headers: dict = None, stream: bool = False, timeout: float = None) -> requests.Response:
+    host = urlsplit(url).hostname
+    settings = host_settings(host, config)
+    bucket = bucket_for(host, settings)
+    # requests already asks for gzip and deflate, which the API's JSON compresses well with
+    request_headers = {"User-Agent": settings["user_agent"]}
+    request_headers.update(headers or {})
+    retries = settings["retries"]
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            response = get_session().get(url, headers=request_headers, stream=stream, timeout=timeout or settings["timeout"])
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if stream:
+                raise
+            if attempt == retries:
+                raise RequestFailed(None, url, str(e))
+            delay = backoff(attempt, settings["max_backoff"])
+            logging.debug(f"Request to {url} failed, trying again in {delay:.1f}s: {e}")
+            time.sleep(delay)
+            continue
+        if response.status_code not in RETRY_STATUSES or attempt == retries:
+            return response
+        delay = retry_after(response)
+        if delay is not None:
+            delay = min(delay, settings["max_backoff"])
+            # Everything else headed for this host has to wait as well
+            if bucket is not None:
+                bucket.block(delay)
+        else:
+            delay = backoff(attempt, settings["max_backoff"])
+        logging.debug(f"{host} answered {response.status_code}, trying again in {delay:.1f}s")
+        response.close()
+        time.sleep(delay)
+
+"""
+Work out how long to wait before the next attempt, doubling each time with some jitter
+
+:param attempt: The attempt that failed, counting from zero
+:param max_backoff: The longest wait in seconds
+:returns: The number of seconds to wait
+"""
+def backoff(attempt: int, max_backoff: float) -> float:
+    return min(max_backoff, 2 ** attempt) * random.uniform(0.5, 1)
@@ -1,9 +1,16 @@
 class RequestFailed(Exception):
     "Raised when a request fails."
 
-    def __init__(self, status_code: int):
+    def __init__(self, status_code: int, url: str = None, reason: str = None):
         self.status_code = status_code
-        self.message = f"Request failed with status code {self.status_code}"
+        self.url = url
+        if status_code is None:
+            # The server never answered
+            self.message = f"Request to {url} failed: {reason}"
+        else:
+            self.message = f"Request failed with status code {self.status_code}"
+            if url is not None:
+                self.message += f" for {url}"
         super().__init__(self.message)
 
 class UnsupportedPlatform(Exception):
@@ -11,4 +18,36 @@ class UnsupportedPlatform(Exception):
 
     def __init__(self, message: str):
         self.message = message
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+class DownloadFailed(Exception):
+    "Raised when a download is corrupt, too large or cannot be completed."
+
+    def __init__(self, url: str, reason: str):
+        self.url = url
+        self.message = f"Download of {url} failed: {reason}"
+        super().__init__(self.message)
+
+class ImageTooLarge(Exception):
+    "Raised when an image would take too much memory to decode."
+
+    def __init__(self, path: str, pixels: int, max_pixels: int):
+        self.path = path
+        self.message = f"Image {path} has {pixels} pixels, more than the limit of {max_pixels}"
+        super().__init__(self.message)
+
+class SetterFailed(Exception):
+    "Raised when setting the wallpaper fails on one or more displays."
+
+    def __init__(self, failures: dict):
+        self.failures = failures
+        self.message = "Setting wallpapers failed on " + ", ".join(f"{display} ({reason})" for display, reason in failures.items())
+        super().__init__(self.message)
+
+class UnsupportedSource(Exception):
+    "Raised when a source does not exist or cannot do what is asked of it."
+
+    def __init__(self, source: str, reason: str):
+        self.source = source
+        self.message = f"Source {source} {reason}"
+        super().__init__(self.message)
@@ -0,0 +1,90 @@
+import os
+import glob
+import time
+import logging
+import threading
+
+DRM_PATH = "/sys/class/drm"
+# Seconds a cached layout is trusted for; the connectors do not change when a monitor's
+# resolution, rotation, scale or position does, so the layout is queried again after this anyway
+MAX_AGE = 60
+
+# The display layout as last queried, and the fingerprint of the connectors at that time
+global cached_displays
+cached_displays = None
+cached_fingerprint = None
+cached_at = 0
+displays_lock = threading.Lock()
+
+"""
+Read a small sysfs attribute, returning its first line
+
+:param path: The path to the attribute
+:returns: The first line, or an empty string if it cannot be read
+"""
+def read_attribute(path: str) -> str:
+    try:
+        with open(path, "r") as f:
+            return f.readline().strip()
+    except OSError:
+        return ""
+
+"""
+Fingerprint the connected monitors without talking to the display server
+
+Reading the DRM connectors in sysfs is a handful of small file reads, cheap enough to poll,
+and changes whenever a monitor is plugged in, unplugged, switched off or swapped for another.
+It does not change with the active mode or arrangement of a monitor, see MAX_AGE.
+
+:returns: A hashable fingerprint, or None where the connectors cannot be read (anything but Linux)
+"""
+def topology_fingerprint():
+    connectors = sorted(glob.glob(os.path.join(DRM_PATH, "card*-*")))
+    if not connectors:
+        return None
+    return tuple(
+        (
+            os.path.basename(connector),
+            read_attribute(os.path.join(connector, "status")),
+            read_attribute(os.path.join(connector, "enabled")),
+            # The preferred mode comes first
+            read_attribute(os.path.join(connector, "modes")),
+        )
+        for connector in connectors
+    )
+
+"""
+Get the display layout, only asking the display server when the monitors may have changed
+
+:param refresh: Query the display server even if the layout is cached
+:param max_age: Seconds the cached layout may be reused for
+:returns: A list of screeninfo monitors
+"""
+def get_displays(refresh: bool = False, max_age: float = MAX_AGE) -> list:
+    global cached_displays, cached_fingerprint, cached_at
+    with displays_lock:
+        fingerprint = topology_fingerprint()
+        stale = cached_displays is None or time.monotonic() - cached_at >= max_age
+        # Without a fingerprint there is no telling when the layout is stale, so always ask
+        if refresh or stale or fingerprint is None or fingerprint != cached_fingerprint:
+            import screeninfo
+            cached_displays = screeninfo.get_monitors()
+            cached_fingerprint = fingerprint
+            cached_at = time.monotonic()
+            logging.debug(f"Queried display layout: {', '.join(f'{display.width}x{display.height}' for display in cached_displays)}")
+        return cached_displays
+
+"""
+Check whether the monitors have changed since the display layout was last queried
+
+:returns: True if they have; the next get_displays call will query the new layout
+"""
+def topology_changed() -> bool:
+    with displays_lock:
+        if cached_displays is None:
+            return False
+        fingerprint = topology_fingerprint()
+        if fingerprint is None or fingerprint == cached_fingerprint:
+            return False
+    logging.debug("Monitors have changed")
+    return True
@@ -1,31 +1,204 @@
+import os
+import asyncio
 import logging
-import tempfile
+import hashlib
 import requests
+from konawall import cache, client, metrics
 from konawall.custom_print import kv_print
+from konawall.custom_errors import DownloadFailed, ImageTooLarge, RequestFailed
+from konawall.imager import check_decodable
+from konawall.post import print_post
+from konawall.selection import download_targets
+
+# Size of each chunk read from the network and written to disk
+CHUNK_SIZE = 64 * 1024
 
 """
-Download files given a list of URLs
+Stream a URL into an open file, resuming from the current file size if possible
 
-:param files: A list of URLs to download from
+:param url: The URL to download from
+:param image_file: The open binary file to append to
+:param max_bytes: The largest file size we are willing to accept
+:param timeout: The connect and read timeout in seconds
+:param config: The configuration, used for the [http] table
+"""
+def stream_to_file(url: str, image_file, max_bytes: int, timeout: float, config: dict = {}):
+    # Ranges and sizes are counted in bytes of the file itself, not of a compressed transfer
+    headers = {"Accept-Encoding": "identity"}
+    offset = image_file.tell()
+    if offset:
+        # We already have part of the file, ask only for the rest
+        headers["Range"] = f"bytes={offset}-"
+        logging.debug(f"Resuming {url} from byte {offset}")
+    with client.get(url, config, headers=headers, stream=True, timeout=timeout) as response:
+        if offset and response.status_code == 200:
+            # The server ignored the Range header and sent everything again, so start over
+            logging.debug(f"Server does not support ranges for {url}, restarting download")
+            image_file.seek(0)
+            image_file.truncate()
+        elif offset and response.status_code == 416:
+            # Nothing is left to fetch, the interruption happened after the last byte
+            return
+        elif response.status_code not in (200, 206):
+            raise RequestFailed(response.status_code, url)
+        # Reject files that announce themselves as too large before reading any of them
+        length = response.headers.get("Content-Length")
+        if length is not None and image_file.tell() + int(length) > max_bytes:
+            raise DownloadFailed(url, f"file is larger than {max_bytes} bytes")
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            image_file.write(chunk)
+            # The Content-Length header is optional, so keep checking as we go
+            if image_file.tell() > max_bytes:
+                raise DownloadFailed(url, f"file is larger than {max_bytes} bytes")
+
+"""
+Compute the MD5 checksum of a file without reading it all into memory
+
+:param path: The path to the file
+:returns: The hex digest of the file
 """
-def download_files(files: list) -> list:
-    logging.debug(f"download_posts() called with files=[{', '.join(files)}]")
-    # Keep a list of downloaded files
-    downloaded_files: list = []
-    # Download the images
-    for i, url in enumerate(files):
+def file_md5(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+"""
+Download a single file given a URL, streaming it to disk and verifying it
+
+:param url: The URL to download from
+:param checksum: The expected MD5 checksum of the file, if known
+:param config: The configuration, used for the size cap, timeout and retry count
+:returns: The path to the downloaded file
+"""
+def download_file(url: str, checksum: str = None, config: dict = {}) -> str:
+    with metrics.span("download", url=url) as span:
+        # Images we have seen before are served straight from the cache
+        key = cache.image_key(url, checksum)
+        cached = cache.lookup(key, config)
+        if cached is not None:
+            logging.debug(f"Cache hit for {url} at {cached}")
+            span.set("cache", "hit")
+            return cached
+        span.set("cache", "miss")
         logging.debug(f"Downloading {url}")
-        # Get the image data
-        image = requests.get(url)
-        # Create a temporary file to store the image
-        image_file = tempfile.NamedTemporaryFile(delete=False)
+        max_bytes = config.get("download_max_bytes", 64 * 1024 * 1024)
+        timeout = config.get("download_timeout", 30)
+        retries = config.get("download_retries", 3)
+        # Create a temporary file in the cache to stream the image into
+        image_file = cache.new_part_file(config)
         logging.debug(f"Created temporary file {image_file.name}")
-        # Write the image data to the file
-        image_file.write(image.content)
-        # Close the file
-        image_file.close()
+        try:
+            with image_file:
+                for attempt in range(retries + 1):
+                    try:
+                        stream_to_file(url, image_file, max_bytes, timeout, config)
+                        break
+                    except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                        # Interrupted transfers are picked up again where they stopped on the next attempt
+                        if attempt == retries:
+                            raise DownloadFailed(url, str(e))
+                        logging.debug(f"Download of {url} interrupted at byte {image_file.tell()}: {e}")
+            # Reject corrupt files before anything tries to decode them
+            if checksum is not None:
+                actual = file_md5(image_file.name)
+                if actual != checksum.lower():
+                    raise DownloadFailed(url, f"checksum mismatch, expected {checksum}, got {actual}")
+                logging.debug(f"Verified checksum {actual} for {url}")
+        except Exception:
+            os.remove(image_file.name)
+            raise
+        span.set("bytes", os.path.getsize(image_file.name))
+        return cache.store(image_file.name, key, config)
+
+"""
+Download files given a list of URLs, from async code
+
+The transfers themselves still go through requests, each in a worker thread, with a semaphore
+bounding how many run at once.
+
+:param files: A list of URLs to download from
+:param config: The configuration, used for the download concurrency limit
+:param checksums: A list of expected MD5 checksums, one per URL, or None to skip verification
+:param return_exceptions: Hand back the error in place of a file that failed, instead of raising it
+:returns: A list of downloaded files, in the same order as the URLs
+"""
+async def download_files_async(files: list, config: dict = {}, checksums: list = None, return_exceptions: bool = False) -> list:
+    logging.debug(f"download_files_async() called with files=[{', '.join(files)}]")
+    if checksums is None:
+        checksums = [None] * len(files)
+    semaphore = asyncio.Semaphore(max(1, config.get("download_concurrency", 4)))
+    async def bounded_download(url: str, checksum: str) -> str:
+        async with semaphore:
+            return await asyncio.to_thread(download_file, url, checksum, config)
+    # gather() hands the results back in input order, and unless asked otherwise cancels the rest if one fails
+    with metrics.span("download_files", count=len(files)):
+        downloaded_files: list = await asyncio.gather(*(
+            bounded_download(url, checksum) for url, checksum in zip(files, checksums)
+        ), return_exceptions=return_exceptions)
+    for i, file in enumerate(downloaded_files):
         # Give the user data about the downloaded image
-        kv_print(f"Image {str(i+1)}", image_file.name)
-        # Add the file to the list of downloaded files
-        downloaded_files.append(image_file.name)
-    return downloaded_files
\ No newline at end of file
+        kv_print(f"Image {str(i+1)}", file)
+    # Eviction walks the cache directory, which is no work for the event loop
+    await asyncio.to_thread(cache.evict, "images", config, keep=[file for file in downloaded_files if isinstance(file, str)])
+    return downloaded_files
+
+"""
+Download the images for posts, swapping posts whose image cannot be had for others
+
+Some problems only show once the download starts, like an image that has gone missing, is over
+download_max_bytes, does not match its checksum or turns out to have more pixels than max_image_pixels,
+which is checked from the image header. Instead of failing the whole rotation for one
+post, the post is dropped and replace is asked for another one for the same display, a few times.
+
+:param posts: The posts, one per display when the displays are known
+:param displays: The displays the posts were chosen for, or None
+:param config: The configuration, used for download_replacements and max_image_pixels
+:param replace: A coroutine function taking (count, displays) and returning that many new posts, or None
+:returns: A (files, posts) tuple, with the posts that were downloaded in the end
+:raises: The error of a post that could not be replaced
+"""
+async def download_posts(posts: list, displays: list, config: dict = {}, replace: callable = None) -> tuple:
+    posts = list(posts)
+    files = [None] * len(posts)
+    pending = list(range(len(posts)))
+    replacements = config.get("download_replacements", 3)
+    # The displays for some of the posts, or None when not all of them have one
+    def displays_for(indices: list) -> list:
+        if not displays or any(i >= len(displays) for i in indices):
+            return None
+        return [displays[i] for i in indices]
+    for attempt in range(replacements + 1):
+        for i in pending:
+            print_post(posts[i])
+        # Download the smallest rendition that covers each display
+        urls, checksums = download_targets([posts[i] for i in pending], displays_for(pending), config)
+        results = await download_files_async(urls, config, checksums, return_exceptions=True)
+        failed = []
+        for i, result in zip(pending, results):
+            if isinstance(result, str):
+                display = displays_for([i])
+                try:
+                    # Catch what the compositor would refuse to decode while there is still time to swap it
+                    await asyncio.to_thread(check_decodable, result, (display[0].width, display[0].height) if display else None, config)
+                except ImageTooLarge as e:
+                    result = e
+            if isinstance(result, (DownloadFailed, RequestFailed, ImageTooLarge)):
+                logging.warning(f"Dropping post {posts[i].id}: {result}")
+                failed.append((i, result))
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                files[i] = result
+        if not failed:
+            return files, posts
+        if replace is None or attempt == replacements:
+            raise failed[0][1]
+        pending = [i for i, _ in failed]
+        new_posts = await replace(len(pending), displays_for(pending))
+        if len(new_posts) < len(pending):
+            # The pool has run dry, which is no better than the download failing
+            raise failed[len(new_posts)][1]
+        for i, post in zip(pending, new_posts):
+            posts[i] = post
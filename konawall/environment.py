@@ -1,8 +1,9 @@
 import sys
 import os
+import asyncio
 import logging
-from konawall.custom_errors import UnsupportedPlatform
-from konawall.module_loader import environment_handlers
+import subprocess
+from konawall.custom_errors import SetterFailed
 
 """
 This detects the DE/WM from the Linux environment because it's not provided by the platform
@@ -51,11 +52,72 @@ def detect_environment():
     return environment
 
 """
-    This sets wallpapers on any platform, as long as it is supported.
+Run a command without blocking the event loop, for async setters
+
+:param command: The command and its arguments
+:param timeout: How many seconds to wait before killing the command, or None to wait forever
+:returns: The completed process, with stdout and stderr captured as bytes
 """
-def set_environment_wallpapers(environment: str, files: list, displays: list):
-    if f"{environment}_setter" in environment_handlers:
-        environment_handlers[f"{environment}_setter"](files, displays)
-        logging.debug("Wallpapers set!")
-    else:
-        UnsupportedPlatform(f"Environment {environment} is not supported, sorry!")
+async def run_command(command: list, timeout: float = None):
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # Do not leave the command running behind our back
+        process.kill()
+        await process.wait()
+        raise
+    logging.debug(f"{' '.join(command)} exited with {process.returncode}")
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+"""
+Run one command per display at the same time, so that applying wallpapers takes as long as the slowest display
+
+:param commands: A dictionary of display names to the command for that display
+:param timeout: How many seconds each command may take
+:raises SetterFailed: If any command failed or timed out, naming every display it happened on
+"""
+async def run_display_commands(commands: dict, timeout: float = 30):
+    results = await asyncio.gather(
+        *(run_command(command, timeout) for command in commands.values()),
+        return_exceptions=True,
+    )
+    failures = {}
+    for display, result in zip(commands, results):
+        if isinstance(result, asyncio.TimeoutError):
+            failures[display] = f"timed out after {timeout}s"
+        elif isinstance(result, asyncio.CancelledError):
+            raise result
+        elif isinstance(result, Exception):
+            failures[display] = str(result)
+        elif result.returncode != 0:
+            failures[display] = result.stderr.decode("utf-8", errors="replace").strip() or f"exit status {result.returncode}"
+    for display, reason in failures.items():
+        logging.error(f"Setting the wallpaper on {display} failed: {reason}")
+    if failures:
+        raise SetterFailed(failures)
+
+"""
+Set wallpapers with swww, for the Wayland compositors that use it
+
+Every display is handed a display-sized rendition rather than making swww scale the original, and
+all of them transition at the same time instead of one after the other.
+
+:param files: The wallpapers, one per display
+:param displays: The displays, by the output names swww knows them by
+:param config: The configuration, used for setter_timeout and the rendition options
+:raises SetterFailed: If swww failed on any display
+"""
+async def set_swww_wallpapers(files: list, displays: list, config: dict = {}):
+    # Loading the imager pulls in Pillow, which only setters need
+    from konawall.imager import render_for_displays
+    files = await asyncio.to_thread(render_for_displays, files, displays, config)
+    commands = {
+        display.name: ["swww", "img", "-o", display.name, file]
+        for file, display in zip(files, displays)
+    }
+    await run_display_commands(commands, config.get("setter_timeout", 30))
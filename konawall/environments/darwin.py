@@ -7,7 +7,7 @@ This sets wallpapers on Darwin.
 :param files: A list of files to set as wallpapers
 """
 @add_environment("darwin_setter")
-def set_wallpapers(files: list, displays: list):
+def set_wallpapers(files: list, displays: list, config: dict = {}):
     for i, file in enumerate(files):
         # Run osascript to set the wallpaper for each monitor
         command = f'tell application "System Events" to set picture of desktop {i-1} to "{file}"'
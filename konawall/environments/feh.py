@@ -1,9 +1,11 @@
-import subprocess
-import dbus
-import time
+import asyncio
 from konawall.module_loader import add_environment
+from konawall.environment import run_command
+from konawall.imager import render_for_displays
 
 @add_environment("feh_setter")
-def set_wallpapers(files: list, displays: list):
+async def set_wallpapers(files: list, displays: list, config: dict = {}):
+    # --bg-fill would otherwise rescale the full-size originals on every display
+    files = await asyncio.to_thread(render_for_displays, files, displays, config)
     command = ["feh", "--bg-fill"] + files
-    subprocess.run(command)
+    await run_command(command)
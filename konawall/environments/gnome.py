@@ -1,10 +1,14 @@
-import subprocess
+import asyncio
 from konawall.module_loader import add_environment
+from konawall.environment import run_display_commands
 from konawall.imager import combine_to_viewport
 
 @add_environment("gnome_setter")
-def set_wallpapers(files: list, displays: list):
-    file = combine_to_viewport(displays, files)
-    command = ["gsettings", "set", "org.gnome.desktop.background", "picture-uri", f"file://{file.name}"]
-    command = ["gsettings", "set", "org.gnome.desktop.background", "picture-uri-dark", f"file://{file.name}"]
-    subprocess.run(command)
+async def set_wallpapers(files: list, displays: list, config: dict = {}):
+    file = await asyncio.to_thread(combine_to_viewport, displays, files, config, "gnome")
+    # Light and dark styles each have their own key, write both at once
+    commands = {
+        "picture-uri": ["gsettings", "set", "org.gnome.desktop.background", "picture-uri", f"file://{file}"],
+        "picture-uri-dark": ["gsettings", "set", "org.gnome.desktop.background", "picture-uri-dark", f"file://{file}"],
+    }
+    await run_display_commands(commands, config.get("setter_timeout", 30))
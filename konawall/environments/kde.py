@@ -1,6 +1,8 @@
-import subprocess
+import json
+import logging
 import dbus
 from konawall.module_loader import add_environment
+from konawall.imager import render_for_displays
 
 # https://powersnail.com/2023/set-plasma-wallpaper/
 
@@ -33,23 +35,72 @@ SCRIPT_ONE = f"""
 {SCRIPT_SET_WALLPAPER}
 setWallpaper(getDesktops()[DESKTOP_ID], IMAGE);
 """
+# The scripts are cut up around their placeholders once, so a rotation only has to join strings
+SCRIPT_ALL_PREFIX, SCRIPT_ALL_SUFFIX = SCRIPT_ALL.split("IMAGE_LIST")
+SCRIPT_ONE_PREFIX, SCRIPT_ONE_REST = SCRIPT_ONE.split("DESKTOP_ID")
+SCRIPT_ONE_MIDDLE, SCRIPT_ONE_SUFFIX = SCRIPT_ONE_REST.split("IMAGE")
+
+# The PlasmaShell interface and its bus, kept between rotations instead of reconnecting each time
+plasma = None
+bus = None
+# The image last set on each desktop, so that only desktops that change are touched
+current_images = {}
+
 """
 This sets the wallpaper on KDE.
 """
 
 def quote(s):
-    return "'" + s + "'"
+    # A JSON string is a valid JavaScript string, whatever quotes or backslashes the path has in it
+    return json.dumps(s)
 
-def plasma_dbus():
-    bus = dbus.SessionBus()
-    plasma = dbus.Interface(
-        bus.get_object("org.kde.plasmashell", "/PlasmaShell"), dbus_interface="org.kde.PlasmaShell"
-    )
+def plasma_dbus(reconnect: bool = False):
+    global plasma, bus
+    if plasma is None or reconnect:
+        if bus is not None:
+            bus.close()
+        # A private connection, so that closing it on reconnection does not affect anyone else
+        bus = dbus.SessionBus(private=True)
+        plasma = dbus.Interface(
+            bus.get_object("org.kde.plasmashell", "/PlasmaShell"), dbus_interface="org.kde.PlasmaShell"
+        )
     return plasma
 
+def evaluate_script(script: str):
+    try:
+        plasma_dbus().evaluateScript(script)
+    except dbus.exceptions.DBusException as e:
+        # Plasma or the session bus may have restarted since the last rotation
+        logging.debug(f"Plasma D-Bus call failed, reconnecting: {e}")
+        plasma_dbus(reconnect=True).evaluateScript(script)
+
 
 @add_environment("kde_setter")
-def set_wallpapers(files: list, displays: list):
-    image_list_string = "[" + ",".join(quote(p) for p in files) + "]"
-    script = SCRIPT_ALL.replace("IMAGE_LIST", image_list_string)
-    plasma_dbus().evaluateScript(script)
\ No newline at end of file
+def set_wallpapers(files: list, displays: list, config: dict = {}):
+    # The script numbers desktops from left to right, which need not be the order screeninfo lists them in
+    pairs = sorted(zip(files, displays), key=lambda pair: (pair[1].x, pair[1].y))
+    displays = [display for _, display in pairs]
+    # Plasma keeps its own scaled copy of every wallpaper, so give it one that is already the right size
+    files = render_for_displays([file for file, _ in pairs], displays, config)
+    if len(current_images) != len(files):
+        # Desktops were added or removed, so what we remember no longer lines up
+        current_images.clear()
+    changed = [i for i, file in enumerate(files) if current_images.get(i) != file]
+    if not changed:
+        logging.debug("Every desktop already shows its wallpaper")
+        return
+    if len(changed) == 1:
+        # Only one desktop changes, so leave the others' config alone
+        i = changed[0]
+        script = SCRIPT_ONE_PREFIX + str(i) + SCRIPT_ONE_MIDDLE + quote(files[i]) + SCRIPT_ONE_SUFFIX
+    else:
+        image_list_string = "[" + ",".join(quote(p) for p in files) + "]"
+        script = SCRIPT_ALL_PREFIX + image_list_string + SCRIPT_ALL_SUFFIX
+    try:
+        evaluate_script(script)
+    except Exception:
+        # We no longer know what each desktop shows
+        current_images.clear()
+        raise
+    for i, file in enumerate(files):
+        current_images[i] = file
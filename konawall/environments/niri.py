@@ -1,11 +1,6 @@
-import subprocess
-import dbus
-import time
 from konawall.module_loader import add_environment
+from konawall.environment import set_swww_wallpapers
 
 @add_environment("niri_setter")
-def set_wallpapers(files: list, displays: list):
-    for i in range(len(displays)):
-        display_name = displays[i].name
-        command = ["swww", "img", "-o", display_name, files[i]]
-        subprocess.run(command)
+async def set_wallpapers(files: list, displays: list, config: dict = {}):
+    await set_swww_wallpapers(files, displays, config)
@@ -0,0 +1,31 @@
+import time
+import asyncio
+from konawall.module_loader import add_environment
+from konawall.imager import combine_to_viewport, render_for_displays
+
+# Every call made to the setter, as dicts of the files, displays and when it was called
+global calls
+calls = []
+
+"""
+This pretends to set wallpapers, only recording that it was asked to; for benchmarks and dry runs.
+
+With composite set to "renditions" or "viewport" in the [null] table, the images are first sized to
+the displays the way the real setters do it, so that the work is still measured.
+
+:param files: A list of files to set as wallpapers
+:param displays: The displays they are for
+:param config: The configuration, used for the [null] table
+"""
+@add_environment("null_setter")
+async def set_wallpapers(files: list, displays: list, config: dict = {}):
+    composite = config.get("null", {}).get("composite")
+    if composite == "viewport":
+        files = [await asyncio.to_thread(combine_to_viewport, displays, files, config)]
+    elif composite == "renditions":
+        files = await asyncio.to_thread(render_for_displays, files, displays, config)
+    calls.append({
+        "files": list(files),
+        "displays": list(displays),
+        "time": time.time(),
+    })
@@ -18,14 +18,14 @@ This sets wallpapers on Windows.
 :param files: A list of files to set as wallpapers
 """
 @add_environment("win32_setter")
-def set_wallpapers(files: list, displays: list):
+def set_wallpapers(files: list, displays: list, config: dict = {}):
     import winreg
     if len(files) > 1:
         logging.debug("Several monitors detected, going the hard route")
         desktop = winreg.OpenKey(winreg.HKEY_CURRENT_USER, "Control Panel\\Desktop", 0, winreg.KEY_ALL_ACCESS)
         wallpaper_style = winreg.SetValueEx(desktop, "WallpaperStyle", 0, winreg.REG_SZ, "5")
         desktop.Close()
-        file = combine_to_viewport(displays, files)
+        file = combine_to_viewport(displays, files, config, "win32")
         ctypes.windll.user32.SystemParametersInfoW(20, 0, file, 0)
     else:
         logging.debug("Detected only one monitor, setting wallpaper simply")
@@ -1,17 +1,40 @@
-import subprocess
 from konawall.module_loader import add_environment
-from konawall.imager import combine_to_viewport
+from konawall.environment import run_command, run_display_commands
 
-@add_environment("xfce_setter")
-def set_wallpapers(files: list, displays: list):
+# The last-image properties found on the previous rotation, so xfconf is only listed when they change
+last_image_properties = []
+# The properties whose image-style has already been set, which only needs doing once
+styled_properties = set()
+
+# List the last-image property of every monitor and workspace
+async def find_last_image_properties(timeout: float) -> list:
     command_for_last_image = ["xfconf-query", "--channel", "xfce4-desktop", "--list"]
-    workspaces_command = subprocess.run(command_for_last_image, capture_output=True)
+    workspaces_command = await run_command(command_for_last_image, timeout)
     workspaces_command_lines = workspaces_command.stdout.decode("utf-8").strip().split("\n")
-    workspaces_command_wallpapers = [conf for conf in workspaces_command_lines if "last-image" in conf]
+    return [conf for conf in workspaces_command_lines if "last-image" in conf]
+
+@add_environment("xfce_setter")
+async def set_wallpapers(files: list, displays: list, config: dict = {}):
+    global last_image_properties
+    timeout = config.get("setter_timeout", 30)
+    if len(last_image_properties) < len(files):
+        last_image_properties = await find_last_image_properties(timeout)
+    style_commands = {}
+    image_commands = {}
     for i, file in enumerate(files):
-        workspace_config = workspaces_command_wallpapers[i]
+        workspace_config = last_image_properties[i]
+        if workspace_config not in styled_properties:
+            style_commands[workspace_config] = ["xfconf-query", "-c", "xfce4-desktop", "-s", "5", "-p"] + [workspace_config.replace("last-image", "image-style")]
         set_command_base = ["xfconf-query", "-c", "xfce4-desktop", "-s", file, "-p"]
-        set_command = set_command_base + [workspace_config]
-        set_style_command = ["xfconf-query", "-c", "xfce4-desktop", "-s", "5", "-p"] + [workspace_config.replace("last-image", "image-style")]
-        subprocess.run(set_style_command)
-        subprocess.run(set_command)
+        image_commands[workspace_config] = set_command_base + [workspace_config]
+    try:
+        # All the style writes go out together, then all the image writes
+        if style_commands:
+            await run_display_commands(style_commands, timeout)
+            styled_properties.update(style_commands)
+        await run_display_commands(image_commands, timeout)
+    except Exception:
+        # Monitors may have come or gone, so look the properties up again next time
+        last_image_properties = []
+        styled_properties.clear()
+        raise
@@ -1,22 +1,17 @@
 #!/usr/bin/env python
 import wx
 import wx.adv
-import tempfile
-from PIL import Image, ImageDraw
 import os
 import sys
 import logging
-import screeninfo
-import tomllib
 import subprocess
 import importlib.metadata
-from konawall.environment import set_environment_wallpapers, detect_environment
 from konawall.module_loader import import_dir, environment_handlers, source_handlers
 from konawall.custom_print import kv_print
-from humanfriendly import format_timespan
+# Everything else is imported where it is used, so that the tray icon appears as early as possible
 
 class Konawall(wx.adv.TaskBarIcon):
-    def __init__(self, version, file_logger, log_path):
+    def __init__(self, version, file_logger, log_path, benchmark=False):
         super().__init__()
         # Prevents it from closing before it has done any work on macOS
         if wx.Platform == "__WXMAC__" or wx.Platform == "__WXGTK__":
@@ -25,23 +20,44 @@ class Konawall(wx.adv.TaskBarIcon):
 
         self.log_path = log_path
         self.config = {}
-        self.wallpaper_rotation_counter = 0 
         self.file_logger = file_logger
         self.version = version
+        # Started by benchmarks/startup.py, which only measures the start up and must not touch the wallpapers
+        self.benchmark = benchmark
         self.title_string = f"Konawall - {version}"
         self.description_string = "A hopefully cross-platform service for fetching wallpapers and setting them."
         self.loaded_before = False
         self.current = []
+        self.current_files = []
 
         print(self.IsAvailable())
         print(self.IsOk())
-        # Call the super function, make sure that the type is the statusitem for macOS
+        # Call the super function, make sure that the type is the statusitem for macOS
         wx.adv.TaskBarIcon.__init__(self, wx.adv.TBI_CUSTOM_STATUSITEM)
 
+        # Set up the taskbar icon first, everything else waits until the event loop is running
+        icon = self.generate_icon()
+        self.SetIcon(icon, self.title_string)
+        self.hidden_frame.SetIcon(icon)
+        wx.CallAfter(self.finish_startup)
+
+    # The rest of the start up, run as the first event once the tray icon is showing
+    def finish_startup(self):
+        from konawall.environment import detect_environment
+        from konawall.pipeline import RotationLoop
+        from konawall.prefetch import Prefetcher
+        from konawall.scheduler import Deadline
+
+        # Fetching and setting happens on an asyncio loop of its own, so the tray stays responsive
+        self.rotation_loop = RotationLoop()
+        self.rotation_future = None
+        self.prefetcher = Prefetcher(self.rotation_loop)
+
         # Detect environment and timer settings
         self.environment = detect_environment()
         self.toggle_wallpaper_rotation_menu_item = None
         self.wallpaper_rotation_timer = wx.Timer(self, wx.ID_ANY)
+        self.display_poll_timer = wx.Timer(self, wx.ID_ANY)
 
         # Reload (actually load) the config and modules.
         if wx.Platform == "__WXGTK__":
@@ -65,12 +81,12 @@ class Konawall(wx.adv.TaskBarIcon):
         self.reload_config()
         self.import_modules()
 
-        # Start the timer to run every second
-        self.wallpaper_rotation_timer.Start(1000)
+        # The timer only wakes us when a rotation or prefetch is due, counting from the first rotation below
+        self.rotation_deadline = Deadline(self.interval)
+        self.prefetch_started = False
+        self.respect_display_poll_interval()
 
-        # Set up the taskbar icon, menu, bindings, ...
-        icon = self.generate_icon()
-        self.SetIcon(icon, self.title_string)
+        # Set up the menu, bindings, ...
         if self.environment in ["hyprland", "niri", "gnome"]:
             import pystray
             def setup(self):
@@ -83,56 +99,66 @@ class Konawall(wx.adv.TaskBarIcon):
                 pystray.MenuItem("Quit",  self.close_program_menu_item)
             ))
             self.external_icon.run_detached(setup)
-        self.hidden_frame.SetIcon(icon)
         self.create_menu()
         self.create_bindings()
 
         # Run the first time, manually
-        self.rotate_wallpapers(None)
+        if not self.benchmark:
+            self.rotate_wallpapers(None)
 
     def open_url(self, evt=None):
         for post in self.current:
-            subprocess.call(["xdg-open", post["show_url"]])
+            subprocess.call(["xdg-open", post.show_url])
 
     def open_log(self, evt=None):
         subprocess.call(["xdg-open", self.log_path])
 
-    # wxPython requires a wx.Bitmap, so we generate one from a PIL.Image
-    def generate_icon_bitmap(self):
-        width = 128
-        height = 128
-
+    # Scale the icon to what the platform wants once, and keep it in the cache so later starts only load it
+    def cached_icon_path(self):
+        from konawall import cache
         # Missing texture style, magenta and black checkerboard
-        image = Image.open(os.path.join(os.path.dirname(__file__), 'icon.png'))
+        icon_path = os.path.join(os.path.dirname(__file__), 'icon.png')
         if "wxMSW" in wx.PlatformInfo:
-            image = image.resize((16, 16))
+            size = (16, 16)
         elif "wxGTK" in wx.PlatformInfo:
-            image = image.resize((22, 22))
-        return image
+            size = (22, 22)
+        else:
+            return icon_path
+        # Named after the source icon's modification time, so a new icon is picked up
+        cached_path = os.path.join(
+            cache.cache_subdir("icons"),
+            f"icon-{size[0]}x{size[1]}-{os.stat(icon_path).st_mtime_ns}.png",
+        )
+        if not os.path.isfile(cached_path):
+            image = wx.Image(icon_path)
+            image.Rescale(size[0], size[1], wx.IMAGE_QUALITY_HIGH)
+            image.SaveFile(cached_path, wx.BITMAP_TYPE_PNG)
+        return cached_path
 
-    def generate_icon(self):
-        image = self.generate_icon_bitmap()
-        # Write image to temporary file
-        temp = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-        image.save(temp.name)
+    # pystray requires a PIL.Image
+    def generate_icon_bitmap(self):
+        from PIL import Image
+        return Image.open(self.cached_icon_path())
 
-        # Convert to wxPython icon
+    def generate_icon(self):
+        # Convert to wxPython icon
         icon = wx.Icon()
-        icon.CopyFromBitmap(wx.Bitmap(temp.name))
+        icon.CopyFromBitmap(wx.Bitmap(self.cached_icon_path(), wx.BITMAP_TYPE_PNG))
         return icon
 
     def toggle_timed_wallpaper_rotation_status(self):
         return f"{'Dis' if self.rotate else 'En'}able Timer"
 
-    # Load in our source and environment handlers
+    # Find our source and environment handlers; they are only imported once they are used
     def import_modules(self):
         import_dir(os.path.join(os.path.dirname(os.path.abspath( __file__ )), "sources"))
-        kv_print("Loaded source handlers", ", ".join(source_handlers), level="debug")
+        kv_print("Found source handlers", ", ".join(source_handlers), level="debug")
         import_dir(os.path.join(os.path.dirname(os.path.abspath( __file__ )), "environments"))
-        kv_print("Loaded environment handlers", ", ".join(environment_handlers), level="debug")
+        kv_print("Found environment handlers", ", ".join(environment_handlers), level="debug")
     
     # Load a TOML file's key-value pairs into our class
     def load_config(self):
+        import tomllib
         if os.path.isfile(self.config_path):
             # If the config file exists, load it as a dictionary into the config variable.
             with open(self.config_path, "rb") as f:
@@ -143,15 +169,16 @@ class Konawall(wx.adv.TaskBarIcon):
                 kv_print(f"Loaded {k}", v)
                 setattr(self, k, v)
         else:
-            # If there is no config file, get complainy.
-            dialog = wx.MessageDialog(
-                None,
-                f"No config file found at {self.config_path}, using defaults.",
-                self.title_string,
-                wx.OK|wx.ICON_INFORMATION
-            )
-            dialog.ShowModal()
-            dialog.Destroy()
+            # If there is no config file, get complainy; unless nobody is there to close the dialog
+            if not self.benchmark:
+                dialog = wx.MessageDialog(
+                    None,
+                    f"No config file found at {self.config_path}, using defaults.",
+                    self.title_string,
+                    wx.OK|wx.ICON_INFORMATION
+                )
+                dialog.ShowModal()
+                dialog.Destroy()
             # Set some arbitrary defaults
             self.rotate = True
             self.source = "konachan"
@@ -181,7 +208,8 @@ class Konawall(wx.adv.TaskBarIcon):
             menu.Append(item)
             return item
         
-        # Create our Menu object
+        from humanfriendly import format_timespan
+        # Create our Menu object
         self.menu = wx.Menu()
 
         # Program header
@@ -234,6 +262,10 @@ class Konawall(wx.adv.TaskBarIcon):
             "Open konawall log in editor"
         )
 
+        # Recent timings of each stage of a rotation, filled in when the menu opens
+        self.metrics_menu = wx.Menu()
+        self.menu.AppendSubMenu(self.metrics_menu, "Timings (p50 / p95)")
+
         create_separator(self.menu)
 
         # Interactive config editing
@@ -259,6 +291,7 @@ class Konawall(wx.adv.TaskBarIcon):
         )
 
     def close_program_menu_item(self, event):
+        self.rotation_loop.stop()
         wx.Exit()
     
     # Interactively edit the config file
@@ -279,6 +312,8 @@ class Konawall(wx.adv.TaskBarIcon):
     def reload_config(self):
         kv_print(f"{'Rel' if self.loaded_before else 'L'}oading config from", self.config_path)
         self.load_config()
+        from konawall import metrics
+        metrics.configure(self.config)
         
         # Handle finding the log level
         if "file" in self.logging:
@@ -292,6 +327,7 @@ class Konawall(wx.adv.TaskBarIcon):
             self.source_menu_item.SetItemLabel(f"Wallpaper source: {self.source}")
             self.respect_timed_wallpaper_rotation_toggle()
             self.respect_current_interval_status()
+            self.respect_display_poll_interval()
             self.create_message_dialog("Config reloaded.")
         
         # Finished loading
@@ -315,6 +351,7 @@ class Konawall(wx.adv.TaskBarIcon):
     
     # Update the menu item of the current interval display to read correctly
     def respect_current_interval_status(self):
+        from humanfriendly import format_timespan
         if self.IsAvailable:
             self.current_interval_menu_item.SetItemLabel(f"Rotation interval: {format_timespan(self.interval)}")
 
@@ -323,56 +360,177 @@ class Konawall(wx.adv.TaskBarIcon):
         self.rotate = not self.rotate
         self.respect_timed_wallpaper_rotation_toggle()
     
-    # Update the timer and the menu item to reflect our current state
+    # Update the timer and the menu item to reflect our current state
     def respect_timed_wallpaper_rotation_toggle(self): 
+        # An interval change applies to the time already waited, as it did with the old counter
+        self.rotation_deadline.seconds = self.interval
         if self.rotate and not self.wallpaper_rotation_timer.IsRunning():
-            self.wallpaper_rotation_timer.Start(1000)
+            # Turning rotation back on starts a fresh interval
+            self.rotation_deadline.start(self.interval)
+            self.prefetch_started = False
+            self.schedule_next_wakeup()
+        elif self.rotate:
+            self.schedule_next_wakeup()
         elif not self.rotate and self.wallpaper_rotation_timer.IsRunning():
             self.wallpaper_rotation_timer.Stop()
-            # Set the time left counter to show that it is disabled
-            if self.IsAvailable:
-                self.current_interval_menu_item.SetItemLabel(f"Automatic wallpaper rotation disabled")
-        
-        # Update the menu item for the toggle
+
+        # Update the menu item for the toggle
         if self.IsAvailable:
             self.toggle_wallpaper_rotation_menu_item.SetItemLabel(self.toggle_timed_wallpaper_rotation_status())
 
-    # Update wallpaper rotation time left counter
+    # Update wallpaper rotation time left counter; only done when the menu opens, not on a timer
     def respect_timed_wallpaper_rotation_status(self):
-        if self.IsAvailable:
-            self.timed_wallpaper_rotation_status_menu_item.SetItemLabel(f"Next rotation: {format_timespan(self.interval - self.wallpaper_rotation_counter)} remaining")
+        from humanfriendly import format_timespan
+        if not self.IsAvailable:
+            return
+        if self.rotate:
+            remaining = round(self.rotation_deadline.remaining())
+            self.timed_wallpaper_rotation_status_menu_item.SetItemLabel(f"Next rotation: {format_timespan(remaining)} remaining")
+        else:
+            self.timed_wallpaper_rotation_status_menu_item.SetItemLabel("Automatic wallpaper rotation disabled")
 
     # Perform the purpose of the application; get new wallpaper media and set 'em.
     def rotate_wallpapers(self, event):
-        displays = screeninfo.get_monitors()
-        count = len(displays)
-        files, self.current = source_handlers[self.source](count, self.tags, self.config)
-        set_environment_wallpapers(self.environment, files, displays)
-
-    # For macOS
+        from konawall.displays import get_displays
+        # Once per rotation is cheap, and catches resolution and arrangement changes the poll cannot see
+        displays = get_displays(refresh=True)
+        # Every rotation, whether timed or not, starts the interval over
+        self.rotation_deadline.start(self.interval)
+        self.prefetch_started = False
+        # This may be called from pystray's thread, and wx timers belong to the main thread
+        wx.CallAfter(self.schedule_next_wakeup)
+        # A newer rotation supersedes one that is still in progress
+        if self.rotation_future is not None and not self.rotation_future.done():
+            logging.debug("Cancelling the rotation in progress")
+            self.rotation_future.cancel()
+        self.rotation_future = self.rotation_loop.submit(self.rotate_wallpapers_async(displays))
+        self.rotation_future.add_done_callback(self.handle_rotation_done)
+
+    # Runs on the rotation loop
+    async def rotate_wallpapers_async(self, displays):
+        from konawall.pipeline import rotate
+        # Use what was fetched in the background during the interval, if it is still good
+        prefetched = await self.prefetcher.take(self.source, displays, self.tags, self.config.get("prefetch_max_age", 60*60))
+        files, self.current = await rotate(self.source, self.environment, displays, self.tags, self.config, prefetched)
+        # Kept so that a change of monitors can be handled without fetching anything
+        self.current_files = files
+
+    # Runs on the rotation loop; set the current wallpapers again for a new display layout
+    async def rerender_wallpapers_async(self, displays):
+        from konawall.pipeline import set_rotation
+        files = [file for file in self.current_files if os.path.isfile(file)]
+        if not files:
+            logging.debug("Current wallpapers are no longer cached, rotating instead")
+            await self.rotate_wallpapers_async(displays)
+            return
+        # A monitor that was just plugged in gets a wallpaper another one already has
+        files = [files[i % len(files)] for i in range(len(displays))]
+        await set_rotation(self.environment, files, displays, self.config)
+
+    # Report rotations that went wrong, rather than losing the exception with the future
+    def handle_rotation_done(self, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logging.error(f"Rotating wallpapers failed: {error!r}")
+
+    # Fetch the next rotation's wallpapers in the background
+    def prefetch_wallpapers(self):
+        from konawall.displays import get_displays
+        self.prefetcher.start(self.source, get_displays(), self.tags, self.config)
+
+    # Start or stop polling for monitor changes to match the config
+    def respect_display_poll_interval(self):
+        from konawall.displays import topology_fingerprint
+        # Seconds between checks for monitors being plugged in or removed; off unless asked for, since
+        # every rotation queries the layout anyway and a poll would wake the app up between rotations
+        poll_interval = self.config.get("display_poll_interval", 0)
+        if poll_interval and topology_fingerprint() is not None:
+            self.display_poll_timer.Start(int(poll_interval * 1000))
+        elif self.display_poll_timer.IsRunning():
+            self.display_poll_timer.Stop()
+
+    # Check whether the monitors have changed, and give them wallpapers if so
+    def handle_display_poll(self, event):
+        from konawall.displays import topology_changed
+        if topology_changed():
+            # Give the display server a moment to apply the new layout before asking it for it
+            wx.CallLater(2000, self.handle_topology_change)
+
+    def handle_topology_change(self):
+        from konawall.displays import get_displays
+        displays = get_displays(refresh=True)
+        if self.rotation_future is not None and not self.rotation_future.done():
+            # The rotation in progress was for the old layout, so start it over for the new one
+            self.rotate_wallpapers(None)
+            return
+        logging.debug("Setting the current wallpapers again for the new display layout")
+        self.rotation_future = self.rotation_loop.submit(self.rerender_wallpapers_async(displays))
+        self.rotation_future.add_done_callback(self.handle_rotation_done)
+
+    # Fill the timings submenu with the percentiles of recent rotations
+    def respect_metrics_status(self):
+        from konawall import metrics
+        for item in self.metrics_menu.GetMenuItems():
+            self.metrics_menu.Delete(item)
+        if not metrics.enabled:
+            labels = ["Metrics are disabled"]
+        else:
+            labels = [
+                f"{name}: {p50:.2f}s / {p95:.2f}s ({count} samples)"
+                for name, (p50, p95, count) in metrics.summary().items()
+            ] or ["Nothing timed yet"]
+        for label in labels:
+            self.metrics_menu.Append(wx.ID_ANY, label).Enable(False)
+
+    # For macOS
     def CreatePopupMenu(self):
+        self.respect_timed_wallpaper_rotation_status()
+        self.respect_metrics_status()
         self.PopupMenu(self.menu)
 
-    # For everybody else who has bindable events
+    # For everybody else who has bindable events
     def show_popup_menu(self, event):
+        self.respect_timed_wallpaper_rotation_status()
+        self.respect_metrics_status()
         self.PopupMenu(self.menu)
-    
-    # Every second, check if the wallpaper rotation timer has ticked over
+
+    # Seconds until the prefetch for the next rotation should start, or None if there is none to do
+    def prefetch_remaining(self):
+        # Start fetching the next rotation this many seconds before it is due, zero turns prefetching off
+        prefetch = self.config.get("prefetch", 60)
+        if not prefetch or self.prefetch_started:
+            return None
+        return self.rotation_deadline.remaining() - prefetch
+
+    # Arm the one-shot timer for whichever comes first, the prefetch or the rotation
+    def schedule_next_wakeup(self):
+        from konawall.scheduler import sleep_for
+        if not self.rotate:
+            return
+        seconds = sleep_for([self.prefetch_remaining(), self.rotation_deadline.remaining()])
+        logging.debug(f"Next wake up in {seconds:.1f}s")
+        # Round up, so that we never wake up just short of a deadline
+        self.wallpaper_rotation_timer.StartOnce(int(seconds * 1000) + 1)
+
+    # Called when the one-shot timer fires, which is only when something is due (or after a long sleep)
     def handle_timer_tick(self, event):
-        if self.wallpaper_rotation_counter >= self.interval:
-            # If it has, run the fetch and set mechanism
+        # Checked against the wall clock as well, in case we were suspended through the deadline
+        if self.rotation_deadline.due():
+            # If it has, run the fetch and set mechanism
             self.rotate_wallpapers(None)
-            self.wallpaper_rotation_counter = 0
-        else:
-            self.wallpaper_rotation_counter += 1
-        # Update the time left counter
-        self.respect_timed_wallpaper_rotation_status()
-
-    # When the user clicks on the taskbar icon or menu item, run the fetch and set mechanism
-    # then reset the wallpaper rotation timer
+            return
+        prefetch_remaining = self.prefetch_remaining()
+        if prefetch_remaining is not None and prefetch_remaining <= 0:
+            self.prefetch_started = True
+            self.prefetch_wallpapers()
+        self.schedule_next_wakeup()
+
+    # When the user clicks on the taskbar icon or menu item, run the fetch and set mechanism,
+    # which also resets the wallpaper rotation timer
     def handle_manual_wallpaper_rotation(self, event):
         self.rotate_wallpapers(None)
-        self.wallpaper_rotation_counter = 0
 
     # Bind application events
     def create_bindings(self):
@@ -381,6 +539,7 @@ class Konawall(wx.adv.TaskBarIcon):
 
         # Implement the wallpaper rotation timer
         self.Bind(wx.EVT_TIMER, self.handle_timer_tick, self.wallpaper_rotation_timer)
+        self.Bind(wx.EVT_TIMER, self.handle_display_poll, self.display_poll_timer)
 
 def main():
     try:
@@ -418,7 +577,14 @@ def main():
     )
     app = wx.App(redirect=False)
     app.SetExitOnFrameDelete(False)
-    Konawall(version, file_logger, log_path)
+    # benchmarks/startup.py watches for these markers, then lets the application exit
+    benchmark = "KONAWALL_STARTUP_BENCHMARK" in os.environ
+    if benchmark:
+        wx.CallAfter(print, "konawall-benchmark: first-event", flush=True)
+    Konawall(version, file_logger, log_path, benchmark)
+    if benchmark:
+        wx.CallAfter(print, "konawall-benchmark: startup-finished", flush=True)
+        wx.CallAfter(wx.Exit)
     app.MainLoop()
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+import os
+import sys
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from konawall import library
+from konawall.custom_print import kv_print
+from konawall.custom_errors import UnsupportedSource
+from konawall.module_loader import import_dir, source_handlers
+
+"""
+Find the config file the tray application uses
+
+:returns: The path to config.toml
+"""
+def default_config_path() -> str:
+    if sys.platform == "darwin":
+        return os.path.expanduser("~/Library/Application Support/konawall/config.toml")
+    if sys.platform == "win32":
+        return os.path.expandvars("%APPDATA%\\konawall\\config.toml")
+    try:
+        from xdg_base_dirs import xdg_config_home
+        return os.path.join(xdg_config_home(), "konawall", "config.toml")
+    except:
+        return os.path.join(os.path.expanduser("~"), ".config", "konawall", "config.toml")
+
+"""
+Find how to request one page of posts from a source, looking it up the way rotations do
+
+:param source: The name of the source
+:returns: A tuple of (request_posts, page_limit) from the source's module
+:raises UnsupportedSource: If there is no such source, or it has no pages to go through
+"""
+def source_pager(source: str) -> tuple:
+    import_dir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sources"))
+    if source not in source_handlers:
+        raise UnsupportedSource(source, f"does not exist, the sources available are {', '.join(source_handlers)}")
+    module = sys.modules[source_handlers[source].__module__]
+    request_posts = getattr(module, "request_posts", None)
+    page_limit = getattr(module, "PAGE_LIMIT", None)
+    # Local images and sources made of other sources have no API to page through
+    if request_posts is None or page_limit is None:
+        raise UnsupportedSource(source, "cannot be paged through, so it cannot be harvested")
+    return request_posts, page_limit
+
+"""
+Page through a source's API and store every post in the library
+
+Pages are requested a batch at a time, as many at once as the concurrency allows, and the
+harvest stops at the first empty page; the shared HTTP client keeps to the API's rate limit.
+
+:param source: The name of the source
+:param tags: A list of tags to search for
+:param config: The configuration
+:param pages: The most pages to request
+:param concurrency: How many pages to request at once
+:returns: The number of posts stored
+:raises UnsupportedSource: If the source cannot be harvested
+"""
+def harvest(source: str, tags: list, config: dict, pages: int, concurrency: int) -> int:
+    request_posts, page_limit = source_pager(source)
+    # A stable order, so that pages do not overlap the way random ones do
+    if not any(tag.startswith("order:") for tag in tags):
+        tags = tags + ["order:id"]
+    stored = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="konawall-harvest") as executor:
+        for first_page in range(1, pages + 1, concurrency):
+            batch = range(first_page, min(first_page + concurrency, pages + 1))
+            results = list(executor.map(
+                lambda page: request_posts(page_limit, list(tags), config, page),
+                batch,
+            ))
+            for posts in results:
+                library.store(source, posts, config)
+                stored += len(posts)
+            kv_print(f"Harvested pages {batch[0]}-{batch[-1]} from {source}", f"{stored} posts so far")
+            if any(not posts for posts in results):
+                break
+    return stored
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="konawall-harvest",
+        description="Fill the local post library from a source's API, so that rotations can be answered offline",
+    )
+    parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
+    parser.add_argument("-c", "--config", help="the config file to use", type=str, default=default_config_path())
+    parser.add_argument("-s", "--source", help="override the source provider", type=str)
+    parser.add_argument("-p", "--pages", help="the most pages to request", type=int, default=10)
+    parser.add_argument("-j", "--concurrency", help="how many pages to request at once", type=int, default=2)
+    parser.add_argument("tags", nargs="*", help="the tags to search for, instead of the ones in the config")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+
+    config = {}
+    if os.path.isfile(args.config):
+        import tomllib
+        with open(args.config, "rb") as f:
+            config = tomllib.load(f)
+    source = args.source or config.get("source", "konachan")
+    tags = args.tags or config.get("tags", [])
+    try:
+        stored = harvest(source, tags, config, args.pages, max(1, args.concurrency))
+    except UnsupportedSource as e:
+        parser.exit(1, f"{parser.prog}: {e}\n")
+    kv_print(f"Posts stored in the library for {source}", stored)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os
+import time
+import struct
+import hashlib
+import logging
+import threading
+from konawall import cache
+from konawall.custom_print import kv_print
+
+# Each record is a 16 byte digest identifying a post and the time it was shown, in seconds since the epoch
+RECORD = struct.Struct("<16sI")
+HISTORY_FILE = "history.bin"
+
+# The index for the history file in use, see get_index
+global index
+index = None
+index_lock = threading.Lock()
+
+"""
+The posts shown recently, kept in memory as a dict of digests for constant time lookups and on disk
+as an append-only file of fixed size records
+"""
+class SeenIndex:
+    def __init__(self, path: str, window: int):
+        self.path = path
+        self.window = window
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    # Read the history file, keeping only what is still inside the window
+    def load(self):
+        cutoff = time.time() - self.window
+        records = 0
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        # A write cut short leaves a partial record at the end, which is ignored
+        usable = len(data) - len(data) % RECORD.size
+        for digest, shown in RECORD.iter_unpack(memoryview(data)[:usable]):
+            records += 1
+            if shown >= cutoff and shown > self.seen.get(digest, 0):
+                self.seen[digest] = shown
+        kv_print("History entries within the repeat window", len(self.seen), level="debug")
+        # Expired and repeated records only take up space, rewrite the file once they are most of it
+        if records > 2 * len(self.seen) + 1024 or usable != len(data):
+            self.compact()
+
+    # Write out only the live records, replacing the file in one go
+    def compact(self):
+        part_path = self.path + cache.PART_SUFFIX
+        with open(part_path, "wb") as f:
+            f.write(b"".join(RECORD.pack(digest, shown) for digest, shown in self.seen.items()))
+        os.replace(part_path, self.path)
+        logging.debug(f"Compacted history file {self.path}")
+
+    def is_recent(self, post: dict) -> bool:
+        cutoff = time.time() - self.window
+        return any(self.seen.get(digest, 0) >= cutoff for digest in post_digests(post))
+
+    def record(self, posts: list):
+        shown = int(time.time())
+        records = []
+        with self.lock:
+            for post in posts:
+                for digest in post_digests(post):
+                    self.seen[digest] = shown
+                    records.append(RECORD.pack(digest, shown))
+            try:
+                with open(self.path, "ab") as f:
+                    f.write(b"".join(records))
+            except OSError as e:
+                logging.warning(f"Could not write history to {self.path}: {e}")
+
+"""
+Work out the digests a post is known by in the history
+
+A post is recorded both by the MD5 of its file, which catches the same image from another source,
+and by its page URL, for posts whose API does not give an MD5.
+
+:param post: The post
+:returns: A list of 16 byte digests
+"""
+def post_digests(post) -> list:
+    digests = [hashlib.md5(post.show_url.encode()).digest()]
+    if post.md5:
+        digests.append(bytes.fromhex(post.md5))
+    return digests
+
+"""
+Get the history index, loading it on first use
+
+:param config: The configuration, used for repeat_window
+:returns: The index, or None if the history is turned off
+"""
+def get_index(config: dict = {}):
+    global index
+    # Seconds before a post may be shown again, zero turns the history off
+    window = config.get("repeat_window", 7 * 24 * 60 * 60)
+    if not window:
+        return None
+    path = os.path.join(cache.cache_dir(config), HISTORY_FILE)
+    with index_lock:
+        if index is None or index.path != path:
+            index = SeenIndex(path, window)
+        index.window = window
+        return index
+
+"""
+Remember that posts have been shown
+
+:param posts: The posts
+:param config: The configuration
+"""
+def record_shown(posts: list, config: dict = {}):
+    seen = get_index(config)
+    if seen is not None:
+        seen.record(posts)
@@ -1,17 +1,217 @@
+import os
+import time
+import hashlib
 import tempfile
 import logging
-from PIL import Image
-
-def combine_to_viewport(displays: list, files: list):
-    # Create an image that is the size of the combined viewport, with offsets for each display
-    max_width = max([display.x + display.width for display in displays])
-    max_height = max([display.y + display.height for display in displays])
-    combined = Image.new("RGB", (max_width, max_height))
-    for i, file in enumerate(files):
-        open_image = Image.open(file, "r")
-        resized_image = open_image.resize((displays[i].width, displays[i].height))
-        combined.paste(resized_image, (displays[i].x, displays[i].y))
-    file = tempfile.NamedTemporaryFile(delete=False)
-    logging.debug(f"Created temporary file {file.name} to save combined viewport image into")
-    combined.save(file.name, format="PNG")
-    return file
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from konawall import cache, metrics
+from konawall.custom_print import kv_print
+from konawall.custom_errors import ImageTooLarge
+
+# Pillow format name, file extension and encoder options for each compositor output format
+OUTPUT_FORMATS = {
+    # No compression at all, the cheapest to write and for the desktop to read
+    "bmp": ("BMP", ".bmp", {}),
+    # Lossless, but at the fastest compression level rather than the default
+    "png": ("PNG", ".png", {"compress_level": 1}),
+    # Lossy, but visually indistinguishable at this quality and without chroma subsampling
+    "jpeg": ("JPEG", ".jpg", {"quality": 95, "subsampling": 0}),
+}
+
+# Output format used for each environment unless the config says otherwise
+ENVIRONMENT_FORMATS = {
+    "win32": "bmp",
+    "gnome": "jpeg",
+}
+
+# Modes reduce() works on directly; anything else, like palette, 1-bit and 16-bit images, is converted first
+REDUCIBLE_MODES = {"L", "LA", "RGB", "RGBA", "CMYK", "I", "F"}
+
+# Which of the two viewport files was written last, see combine_to_viewport
+viewport_slot = 0
+# The combined image from the last rotation, reused while the viewport size stays the same
+canvas = None
+
+"""
+Refuse an opened image with more pixels than max_image_pixels, at the size it is going to be decoded at
+
+:param image: The opened image, after any draft()
+:param path: The path to the image
+:param config: The configuration, used for max_image_pixels
+:raises ImageTooLarge: If the image is over the limit
+"""
+def check_pixels(image: Image.Image, path: str, config: dict = {}):
+    max_pixels = config.get("max_image_pixels", 100_000_000)
+    if image.width * image.height > max_pixels:
+        raise ImageTooLarge(path, image.width * image.height, max_pixels)
+
+"""
+Check a downloaded image against max_image_pixels from its header alone, without decoding it
+
+:param path: The path to the image
+:param size: The (width, height) it will be shown at, or None if unknown
+:param config: The configuration, used for max_image_pixels
+:raises ImageTooLarge: If load_for_display would refuse the image
+"""
+def check_decodable(path: str, size: tuple = None, config: dict = {}):
+    with Image.open(path, "r") as image:
+        if size is not None:
+            image.draft("RGB", size)
+        check_pixels(image, path, config)
+
+"""
+Decode an image at roughly the size it will be shown at, rather than at its full size
+
+JPEGs are scaled during decoding, everything else is shrunk by an integer factor with reduce()
+before the final resample, so memory use follows the display size instead of the source size.
+
+:param path: The path to the image
+:param size: The (width, height) to resize the image to
+:param config: The configuration, used for max_image_pixels
+:param fit: "stretch" to ignore the aspect ratio, "fill" to crop to it or "fit" to letterbox into it
+:returns: The resized image, in RGB mode
+"""
+def load_for_display(path: str, size: tuple, config: dict = {}, fit: str = "stretch") -> Image.Image:
+    with Image.open(path, "r") as image:
+        original_size = image.size
+        # Let the JPEG decoder do the downscaling with DCT scaling; this is a no-op for other formats
+        image.draft("RGB", size)
+        # The check happens after drafting, as that is the size that actually gets decoded
+        check_pixels(image, path, config)
+        factor = min(image.width // size[0], image.height // size[1])
+        if factor >= 2:
+            source = image
+            if source.mode not in REDUCIBLE_MODES:
+                # GIFs are always palette images, and reduce() rejects those outright
+                has_alpha = "A" in source.mode or "transparency" in source.info
+                source = source.convert("RGBA" if has_alpha else "RGB")
+            # A cheap box reduction to near the target size, so the proper resample has less to do
+            reduced = source.reduce(factor)
+        else:
+            reduced = image
+        if fit == "fill":
+            resized = ImageOps.fit(reduced, size)
+        elif fit == "fit":
+            resized = ImageOps.pad(reduced, size, color="black")
+        else:
+            resized = reduced.resize(size)
+        if resized.mode != "RGB":
+            resized = resized.convert("RGB")
+    logging.debug(f"Decoded {path} from {original_size[0]}x{original_size[1]} via {reduced.width}x{reduced.height} to {size[0]}x{size[1]}")
+    return resized
+
+"""
+Work out the rendition cache file name for an image shown on a display
+
+:param path: The path to the image
+:param size: The (width, height) of the display
+:param fit: The fit mode
+:param config: The configuration, used to find the download cache
+:returns: The file name the rendition is cached under
+"""
+def rendition_key(path: str, size: tuple, fit: str, config: dict = {}) -> str:
+    real_path = os.path.realpath(path)
+    stem, _ = os.path.splitext(os.path.basename(real_path))
+    if os.path.dirname(real_path) == os.path.realpath(cache.cache_subdir("images", config)):
+        # Downloaded images are already named after their content hash
+        content_hash = stem
+    else:
+        # Anything else is identified by where it is and when it last changed
+        stat = os.stat(real_path)
+        content_hash = hashlib.md5(f"{real_path}:{stat.st_mtime_ns}:{stat.st_size}".encode("utf-8")).hexdigest()
+    return f"{content_hash}-{size[0]}x{size[1]}-{fit}.jpg"
+
+"""
+Transcode an image into a display-sized JPEG once, and reuse it every time the image is shown there again
+
+:param path: The path to the image
+:param display: The display the image is for
+:param config: The configuration, used for the [compositor] table
+:returns: The path to the rendition
+"""
+def render_for_display(path: str, display, config: dict = {}) -> str:
+    compositor_config = config.get("compositor", {})
+    fit = compositor_config.get("fit", "stretch")
+    size = (display.width, display.height)
+    key = rendition_key(path, size, fit, config)
+    renditions_dir = cache.cache_subdir("renditions", config)
+    rendition_path = os.path.join(renditions_dir, key)
+    with metrics.span("render", size=f"{size[0]}x{size[1]}") as span:
+        if os.path.isfile(rendition_path):
+            # The modification time doubles as the last-used time for eviction
+            os.utime(rendition_path)
+            logging.debug(f"Rendition cache hit for {path} at {rendition_path}")
+            span.set("cache", "hit")
+            return rendition_path
+        span.set("cache", "miss")
+        start = time.perf_counter()
+        image = load_for_display(path, size, config, fit)
+        # Write next to the final name and move it into place, so nobody sees a half-written rendition
+        with tempfile.NamedTemporaryFile(dir=renditions_dir, suffix=cache.PART_SUFFIX, delete=False) as part_file:
+            image.save(part_file, format="JPEG", quality=compositor_config.get("rendition_quality", 90))
+        image.close()
+        os.replace(part_file.name, rendition_path)
+        kv_print(f"Render time for {path} at {size[0]}x{size[1]}", f"{time.perf_counter() - start:.3f}s", level="debug")
+        return rendition_path
+
+"""
+Render one image per display, in parallel, through the rendition cache
+
+:param files: The images to show, one per display
+:param displays: The displays
+:param config: The configuration, used for the [compositor] table
+:returns: The paths to the renditions, in the same order as the files
+"""
+def render_for_displays(files: list, displays: list, config: dict = {}) -> list:
+    pairs = list(zip(files, displays))
+    if not pairs:
+        return []
+    with metrics.span("render_for_displays", displays=len(pairs)):
+        with ThreadPoolExecutor(max_workers=len(pairs), thread_name_prefix="konawall-render") as executor:
+            renditions = list(executor.map(lambda pair: render_for_display(pair[0], pair[1], config), pairs))
+        # Keep the rendition cache within its own byte budget, leaving the renditions about to be used alone
+        cache.evict(
+            "renditions",
+            config,
+            keep=renditions,
+            max_bytes=config.get("compositor", {}).get("rendition_cache_max_bytes", 256 * 1024 * 1024),
+        )
+    return renditions
+
+"""
+Combine one image per display into a single image spanning every display
+
+:param displays: The displays, with their positions and sizes
+:param files: The images to show, one per display
+:param config: The configuration, used for the [compositor] table
+:param environment: The environment the image is for, which decides the default output format
+:returns: The path to the combined image
+"""
+def combine_to_viewport(displays: list, files: list, config: dict = {}, environment: str = None) -> str:
+    global viewport_slot, canvas
+    compositor_config = config.get("compositor", {})
+    output_format = compositor_config.get("format", ENVIRONMENT_FORMATS.get(environment, "png"))
+    pillow_format, extension, options = OUTPUT_FORMATS[output_format]
+    with metrics.span("combine_to_viewport", format=output_format, displays=len(displays)):
+        start = time.perf_counter()
+        # Create an image that is the size of the combined viewport, with offsets for each display
+        max_width = max([display.x + display.width for display in displays])
+        max_height = max([display.y + display.height for display in displays])
+        if canvas is None or canvas.size != (max_width, max_height):
+            canvas = Image.new("RGB", (max_width, max_height))
+        # Every display's area is painted over below, so the previous rotation never shows through
+        for i, rendition in enumerate(render_for_displays(files, displays, config)):
+            with Image.open(rendition, "r") as rendered_image:
+                canvas.paste(rendered_image, (displays[i].x, displays[i].y))
+        composed = time.perf_counter()
+        # Alternate between two files in the cache rather than leaking a new temporary file every rotation;
+        # desktops tend to ignore being handed the path they are already showing, so it cannot be just one
+        viewport_slot = 1 - viewport_slot
+        path = os.path.join(cache.cache_subdir("viewport", config), f"viewport-{viewport_slot}{extension}")
+        logging.debug(f"Saving combined viewport image into {path}")
+        canvas.save(path, format=pillow_format, **options)
+        saved = time.perf_counter()
+        kv_print("Viewport composition time", f"{composed - start:.3f}s", level="debug")
+        kv_print(f"Viewport {output_format} encoding time", f"{saved - composed:.3f}s", level="debug")
+        return path
@@ -0,0 +1,186 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from konawall import cache
+from konawall.custom_print import kv_print
+from konawall.post import Post
+
+LIBRARY_FILE = "library.sqlite3"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    source TEXT NOT NULL,
+    post_id TEXT NOT NULL,
+    md5 TEXT,
+    width INTEGER,
+    height INTEGER,
+    aspect REAL,
+    rating TEXT,
+    show_url TEXT,
+    added REAL NOT NULL,
+    data TEXT NOT NULL,
+    UNIQUE (source, post_id)
+);
+CREATE INDEX IF NOT EXISTS posts_aspect ON posts (source, aspect);
+CREATE INDEX IF NOT EXISTS posts_resolution ON posts (source, width, height);
+CREATE INDEX IF NOT EXISTS posts_md5 ON posts (md5);
+CREATE TABLE IF NOT EXISTS tags (
+    tag_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS post_tags (
+    tag_id INTEGER NOT NULL,
+    post INTEGER NOT NULL,
+    PRIMARY KEY (tag_id, post)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS post_tags_post ON post_tags (post);
+"""
+# Searches for a minimum size, which the sources add themselves, see konawall.selection.size_tags
+SIZE_TAG = re.compile(r"(width|height):>=(\d+)")
+
+# One connection, shared between threads behind a lock
+global connection
+connection = None
+connection_path = None
+library_lock = threading.Lock()
+
+"""
+Check whether posts are kept in the library
+
+:param config: The configuration, used for the [library] table
+:returns: True if they are
+"""
+def enabled(config: dict = {}) -> bool:
+    return config.get("library", {}).get("enabled", False)
+
+"""
+Open the library, creating it if needed; call with library_lock held
+
+:param config: The configuration, used for the [library] table
+:returns: The connection
+"""
+def connect(config: dict = {}) -> sqlite3.Connection:
+    global connection, connection_path
+    library_config = config.get("library", {})
+    path = os.path.expanduser(library_config.get("path", os.path.join(cache.cache_dir(config), LIBRARY_FILE)))
+    if connection is None or connection_path != path:
+        if connection is not None:
+            connection.close()
+        connection = sqlite3.connect(path, check_same_thread=False)
+        # Readers are not held up by the writes of a harvest running at the same time
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        connection_path = path
+        logging.debug(f"Opened post library {path}")
+    return connection
+
+"""
+Write posts into the library, replacing what it had for them
+
+:param source: The name of the source the posts came from
+:param posts: The posts
+:param config: The configuration
+"""
+def store(source: str, posts: list, config: dict = {}):
+    if not posts:
+        return
+    added = time.time()
+    with library_lock:
+        db = connect(config)
+        with db:
+            for post in posts:
+                cursor = db.execute(
+                    "INSERT INTO posts (source, post_id, md5, width, height, aspect, rating, show_url, added, data)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (source, post_id) DO UPDATE SET data = excluded.data, rating = excluded.rating"
+                    " RETURNING rowid",
+                    (
+                        source,
+                        str(post.id),
+                        post.md5,
+                        post.width,
+                        post.height,
+                        post.width / post.height if post.width and post.height else None,
+                        post.rating,
+                        post.show_url,
+                        added,
+                        json.dumps(post.to_dict()),
+                    ),
+                )
+                rowid = cursor.fetchone()[0]
+                db.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(tag,) for tag in post.tags])
+                db.execute("DELETE FROM post_tags WHERE post = ?", (rowid,))
+                db.executemany(
+                    "INSERT OR IGNORE INTO post_tags (tag_id, post) SELECT tag_id, ? FROM tags WHERE name = ?",
+                    [(rowid, tag) for tag in post.tags],
+                )
+    kv_print(f"Posts stored in the library for {source}", len(posts), level="debug")
+
+"""
+Turn a tag search into SQL conditions on the posts table
+
+:param tags: A list of tags to search for
+:returns: A tuple of (conditions, parameters), or None if the search uses something the library cannot answer
+"""
+def tag_conditions(tags: list) -> tuple:
+    conditions = []
+    parameters = []
+    for tag in tags:
+        negated = tag.startswith("-")
+        name = tag[1:] if negated else tag
+        size = SIZE_TAG.fullmatch(name)
+        if name.startswith("order:"):
+            # Everything from the library comes in random order
+            continue
+        elif name.startswith("rating:") and not negated:
+            conditions.append("p.rating = ?")
+            parameters.append(name[len("rating:"):][:1])
+        elif name.startswith("rating:"):
+            conditions.append("p.rating != ?")
+            parameters.append(name[len("rating:"):][:1])
+        elif size and not negated:
+            conditions.append(f"p.{size.group(1)} >= ?")
+            parameters.append(int(size.group(2)))
+        elif ":" in name or "*" in name:
+            # Other metatags and wildcards are left to the API
+            return None
+        else:
+            conditions.append(
+                f"{'NOT ' if negated else ''}EXISTS (SELECT 1 FROM post_tags pt JOIN tags t ON t.tag_id = pt.tag_id"
+                " WHERE pt.post = p.rowid AND t.name = ?)"
+            )
+            parameters.append(name)
+    return conditions, parameters
+
+"""
+Find posts in the library matching a search
+
+:param source: The name of the source
+:param tags: A list of tags to search for
+:param config: The configuration
+:param limit: The most posts to return
+:param aspect_range: A (lowest, highest) aspect ratio to limit the posts to, or None
+:returns: A list of posts in random order, or None if the search cannot be answered from the library
+"""
+def query(source: str, tags: list, config: dict = {}, limit: int = 100, aspect_range: tuple = None) -> list:
+    found = tag_conditions(tags)
+    if found is None:
+        return None
+    conditions, parameters = found
+    conditions = ["p.source = ?"] + conditions
+    parameters = [source] + parameters
+    if aspect_range is not None:
+        conditions.append("p.aspect BETWEEN ? AND ?")
+        parameters.extend(aspect_range)
+    start = time.perf_counter()
+    with library_lock:
+        rows = connect(config).execute(
+            f"SELECT p.data FROM posts p WHERE {' AND '.join(conditions)} ORDER BY RANDOM() LIMIT ?",
+            parameters + [limit],
+        ).fetchall()
+    kv_print(f"Library query for {source}", f"{len(rows)} posts in {time.perf_counter() - start:.3f}s", level="debug")
+    return [Post.from_dict(json.loads(data)) for (data,) in rows]
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from konawall import cache
+
+# Set by configure(); while False, span() hands out a shared object that does nothing
+global enabled
+enabled = False
+metrics_path = None
+max_file_bytes = 10 * 1024 * 1024
+# The durations of the most recent spans of each name, for the percentiles in the tray menu
+recent = {}
+window = 200
+metrics_lock = threading.Lock()
+
+"""
+A span that records nothing, handed out while metrics are disabled
+"""
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    # Extra fields are thrown away
+    def set(self, key: str, value):
+        pass
+
+NULL_SPAN = NullSpan()
+
+"""
+Times a stage of a rotation, and writes it to the metrics file once it is done
+"""
+class Span:
+    def __init__(self, name: str, fields: dict):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = time.perf_counter() - self.start
+        record = {"name": self.name, "time": self.started, "duration_s": round(duration, 6)}
+        record.update(self.fields)
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        logging.debug(f"{self.name} took {duration:.3f}s")
+        write_record(record)
+        return False
+
+    # Record an extra field, like the number of bytes transferred or whether the cache was hit
+    def set(self, key: str, value):
+        self.fields[key] = value
+
+"""
+Turn metrics on or off, and choose where they are written
+
+:param config: The configuration, used for the [metrics] table
+"""
+def configure(config: dict = {}):
+    global enabled, metrics_path, max_file_bytes, window
+    metrics_config = config.get("metrics", {})
+    with metrics_lock:
+        enabled = metrics_config.get("enabled", False)
+        if "file" in metrics_config:
+            metrics_path = os.path.expanduser(metrics_config["file"])
+        else:
+            metrics_path = os.path.join(cache.cache_dir(config), "metrics.jsonl")
+        max_file_bytes = metrics_config.get("max_file_bytes", 10 * 1024 * 1024)
+        window = metrics_config.get("window", 200)
+        for name in list(recent):
+            recent[name] = deque(recent[name], maxlen=window)
+
+"""
+Time a block of code, when metrics are enabled
+
+    with span("download", url=url) as s:
+        ...
+        s.set("bytes", size)
+
+:param name: What is being timed
+:param fields: Extra fields to write along with the timing
+:returns: A context manager
+"""
+def span(name: str, **fields):
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, fields)
+
+"""
+Keep a finished span for the percentiles, and append it to the metrics file as one line of JSON
+
+:param record: The span's fields
+"""
+def write_record(record: dict):
+    line = json.dumps(record) + "\n"
+    with metrics_lock:
+        durations = recent.get(record["name"])
+        if durations is None:
+            durations = recent[record["name"]] = deque(maxlen=window)
+        durations.append(record["duration_s"])
+        try:
+            # Keep one old file around rather than letting it grow forever
+            if os.path.isfile(metrics_path) and os.path.getsize(metrics_path) > max_file_bytes:
+                os.replace(metrics_path, metrics_path + ".1")
+            with open(metrics_path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            logging.warning(f"Could not write metrics to {metrics_path}: {e}")
+
+"""
+Find a percentile of a sorted list of numbers, by the nearest rank
+
+:param values: The sorted values
+:param percent: The percentile, from 0 to 100
+:returns: The value at that percentile
+"""
+def percentile(values: list, percent: float) -> float:
+    rank = max(1, round(percent / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+"""
+Summarise the recent spans of every name
+
+:returns: A dict of span names to (p50, p95, count) tuples, in seconds
+"""
+def summary() -> dict:
+    with metrics_lock:
+        snapshot = {name: sorted(durations) for name, durations in recent.items() if durations}
+    return {name: (percentile(values, 50), percentile(values, 95), len(values)) for name, values in sorted(snapshot.items())}
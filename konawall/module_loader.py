@@ -1,14 +1,84 @@
-import imp
 import os
 import re
-import inspect
 import logging
+import importlib
+import importlib.metadata
+from collections.abc import MutableMapping
 from konawall.custom_print import kv_print
 
+"""
+A registry of handlers that knows their names without importing them
+
+Handler modules are only imported the first time one of their handlers is looked up, either from
+the files found by import_dir or from the konawall.sources and konawall.environments entry points
+of installed packages.
+"""
+class HandlerRegistry(MutableMapping):
+	def __init__(self, kind: str, entry_point_group: str):
+		self.kind = kind
+		self.entry_point_group = entry_point_group
+		# Handlers that have been imported and registered
+		self.handlers = {}
+		# Handler names to the module that registers them, for handlers not imported yet
+		self.modules = {}
+		# Handler names to entry points, looked up the first time they are needed
+		self.entry_points = None
+
+	# Find handlers provided by other packages, without loading them
+	def discover_entry_points(self) -> dict:
+		if self.entry_points is None:
+			self.entry_points = {}
+			try:
+				for entry_point in importlib.metadata.entry_points(group=self.entry_point_group):
+					self.entry_points[entry_point.name] = entry_point
+			except Exception as e:
+				logging.warning(f"Could not look up {self.entry_point_group} entry points: {e}")
+		return self.entry_points
+
+	def __getitem__(self, name: str) -> callable:
+		if name in self.handlers:
+			return self.handlers[name]
+		if name in self.modules:
+			# Importing the module runs its decorators, which register the handler
+			importlib.import_module(self.modules[name])
+			if name in self.handlers:
+				return self.handlers[name]
+		entry_points = self.discover_entry_points()
+		if name in entry_points:
+			handler = entry_points[name].load()
+			# An entry point may name the handler itself, or a module that registers it with a decorator
+			if callable(handler) and name not in self.handlers:
+				self.handlers[name] = handler
+			kv_print(f"Loaded {self.kind} handler {name} from entry point", entry_points[name].value, level="debug")
+			return self.handlers[name]
+		raise KeyError(name)
+
+	def __setitem__(self, name: str, handler: callable):
+		self.handlers[name] = handler
+
+	def __delitem__(self, name: str):
+		self.handlers.pop(name, None)
+		self.modules.pop(name, None)
+
+	def __contains__(self, name) -> bool:
+		return name in self.handlers or name in self.modules or name in self.discover_entry_points()
+
+	def names(self) -> list:
+		return sorted(set(self.handlers) | set(self.modules) | set(self.discover_entry_points()))
+
+	def __iter__(self):
+		return iter(self.names())
+
+	def __len__(self) -> int:
+		return len(self.names())
+
 global environment_handlers
 global source_handlers
-environment_handlers = {}
-source_handlers = {}
+environment_handlers = HandlerRegistry("environment", "konawall.environments")
+source_handlers = HandlerRegistry("source", "konawall.sources")
+
+# Finds the handler names a module registers, without importing it
+HANDLER_PATTERN = re.compile(r"""@add_(environment|source)\(\s*["']([^"']+)["']\s*\)""")
 
 """
 This finds all modules in a directory
@@ -26,16 +96,22 @@ def modules_in_dir(path: str) -> set:
 	return result
 
 """
-This automatically loads all modules in a directory
+This indexes the handlers of all modules in a directory of the konawall package, to be imported on first use
 
 :param path: The path to the directory
 """
 def import_dir(path: str):
+	package = "konawall." + os.path.basename(os.path.normpath(path))
 	for filename in sorted(modules_in_dir(path)):
-		search_path = os.path.join(os.getcwd(), path)
 		module_name, _ = os.path.splitext(filename)
-		fp, path_name, description = imp.find_module(module_name, [search_path,])
-		imp.load_module(module_name, fp, path_name, description)
+		if module_name == "__init__":
+			continue
+		# Reading the source is much cheaper than importing it, and its dependencies, just to learn the names
+		with open(os.path.join(path, filename), "r", encoding="utf-8") as f:
+			source = f.read()
+		for kind, name in HANDLER_PATTERN.findall(source):
+			registry = environment_handlers if kind == "environment" else source_handlers
+			registry.modules[name] = f"{package}.{module_name}"
 
 """
 This provides a dynamic way to load environment handlers through a decorator
@@ -44,13 +120,11 @@ This provides a dynamic way to load environment handlers through a decorator
 :returns: A function for decoration
 """
 def add_environment(environment: str) -> callable:
-	# Get the current frame
-	frame = inspect.stack()[1]
-	# From the current frame, extract the relative path to the file
-	path = frame[0].f_code.co_filename
 	def wrapper(function):
+		# Handlers may be plain functions or coroutine functions, see konawall.pipeline.call_handler
 		environment_handlers[environment] = function
-		kv_print(f"Loaded environment handler {environment} from", path, level="debug")
+		kv_print(f"Loaded environment handler {environment} from", function.__module__, level="debug")
+		return function
 	return wrapper
 
 """
@@ -60,11 +134,9 @@ This provides a dynamic way to load wallpaper sources through a decorator
 :returns: A function for decoration
 """
 def add_source(source: str) -> callable:
-	# Get the current frame
-	frame = inspect.stack()[1]
-	# From the current frame, extract the relative path to the file
-	path = frame[0].f_code.co_filename
 	def wrapper(function):
+		# Handlers may be plain functions or coroutine functions, see konawall.pipeline.call_handler
 		source_handlers[source] = function
-		kv_print(f"Loaded wallpaper source {source} from", path, level="debug")
-	return wrapper
\ No newline at end of file
+		kv_print(f"Loaded wallpaper source {source} from", function.__module__, level="debug")
+		return function
+	return wrapper
@@ -0,0 +1,128 @@
+import asyncio
+import inspect
+import logging
+import threading
+from konawall import history, metrics
+from konawall.module_loader import environment_handlers, source_handlers
+from konawall.custom_errors import UnsupportedPlatform
+
+"""
+Work out which optional arguments a handler takes
+
+Handlers written before an argument was added, like a source without displays or a setter without
+config, keep working; an argument is only passed if the handler has a parameter of that name.
+
+:param handler: The handler to call
+:param optional: The optional arguments, by name
+:returns: The optional arguments the handler accepts
+"""
+def accepted_arguments(handler: callable, optional: dict) -> dict:
+    try:
+        parameters = inspect.signature(handler).parameters
+    except (TypeError, ValueError):
+        # Some builtins and extension functions cannot be inspected, so give them only what is required
+        return {}
+    if any(parameter.kind == inspect.Parameter.VAR_KEYWORD for parameter in parameters.values()):
+        return optional
+    return {
+        name: value for name, value in optional.items()
+        if name in parameters and parameters[name].kind != inspect.Parameter.POSITIONAL_ONLY
+    }
+
+"""
+Call a source or environment handler from async code, whether it is async itself or not
+
+Plain functions are run in a worker thread, so that they do not hold up the event loop.
+
+:param handler: The handler to call
+:param args: The arguments every handler of its kind takes
+:param optional: Arguments to pass by name, if the handler takes them, see accepted_arguments
+:returns: Whatever the handler returns
+"""
+async def call_handler(handler: callable, *args, **optional):
+    keywords = accepted_arguments(handler, optional)
+    if inspect.iscoroutinefunction(handler):
+        return await handler(*args, **keywords)
+    return await asyncio.to_thread(handler, *args, **keywords)
+
+"""
+Fetch the wallpapers for a rotation from a source
+
+:param source: The name of the source
+:param displays: The displays to fetch wallpapers for
+:param tags: A list of tags to search for
+:param config: The configuration
+:param count: The number of wallpapers to fetch, if not one per display
+:returns: A (files, posts) tuple
+"""
+async def fetch_rotation(source: str, displays: list, tags: list, config: dict, count: int = None) -> tuple:
+    if count is None:
+        count = len(displays)
+    # Sources may append to the tag list they are given, so hand them a copy
+    return await call_handler(source_handlers[source], count, list(tags), config=config, displays=displays)
+
+"""
+Set the wallpapers for a rotation on an environment
+
+:param environment: The name of the environment
+:param files: The wallpapers, one per display
+:param displays: The displays
+:param config: The configuration
+"""
+async def set_rotation(environment: str, files: list, displays: list, config: dict):
+    if f"{environment}_setter" not in environment_handlers:
+        raise UnsupportedPlatform(f"Environment {environment} is not supported, sorry!")
+    with metrics.span(f"{environment}_setter", displays=len(displays)):
+        await call_handler(environment_handlers[f"{environment}_setter"], files, displays, config=config)
+    logging.debug("Wallpapers set!")
+
+"""
+Fetch and set a rotation of wallpapers
+
+:param source: The name of the source
+:param environment: The name of the environment
+:param displays: The displays
+:param tags: A list of tags to search for
+:param config: The configuration
+:param prefetched: A (files, posts) tuple fetched ahead of time, or None to fetch them now
+:param count: The number of wallpapers to fetch, if not one per display
+:returns: A (files, posts) tuple
+"""
+async def rotate(source: str, environment: str, displays: list, tags: list, config: dict, prefetched: tuple = None, count: int = None) -> tuple:
+    if prefetched is None:
+        prefetched = await fetch_rotation(source, displays, tags, config, count)
+    files, posts = prefetched
+    await set_rotation(environment, files, displays, config)
+    # Only what was actually shown counts against the repeat window
+    await asyncio.to_thread(history.record_shown, posts, config)
+    return files, posts
+
+"""
+An asyncio event loop running on its own thread, for callers like the wx GUI that have a loop of their own
+"""
+class RotationLoop:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name="konawall-loop", daemon=True)
+        self.thread.start()
+
+    # Runs on the loop thread
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    # Schedule a coroutine on the loop, returning a concurrent.futures.Future for its result
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    # Cancel everything still running, let it clean up, and stop the loop
+    def stop(self):
+        async def shutdown():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.loop.stop()
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop)
+        self.thread.join()
@@ -0,0 +1,194 @@
+import math
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from konawall import history, library
+from konawall.custom_print import kv_print
+
+# One pool per source, replaced whenever the tags for that source change
+global pools
+pools = {}
+pools_lock = threading.Lock()
+
+"""
+An in-memory pool of posts for one source and one set of tags, so that a rotation
+does not need an API round trip of its own
+"""
+class PostPool:
+    def __init__(self, source: str, fetch_page: callable, page_limit: int, tags: list):
+        self.source = source
+        self.fetch_page = fetch_page
+        self.page_limit = page_limit
+        self.tags = list(tags)
+        self.posts = []
+        # Posts shown too recently to be handed out, unless there is nothing else
+        self.repeats = []
+        # The most recently taken posts' IDs, in the order they were taken; the only posts it takes back
+        self.taken_ids = {}
+        self.lock = threading.Lock()
+        self.refill_thread = None
+
+    # Add posts to the pool, skipping ones it already has and putting aside ones shown recently
+    def add_posts(self, posts: list, config: dict) -> int:
+        with self.lock:
+            # Random ordering means pages can overlap, so skip posts we already have
+            seen = set(post.id for post in self.posts)
+            shown = history.get_index(config)
+            added = 0
+            repeats = 0
+            for post in posts:
+                if post.id in seen:
+                    continue
+                seen.add(post.id)
+                # Weed out what was shown recently before anything is downloaded
+                if shown is not None and shown.is_recent(post):
+                    repeats += 1
+                    self.repeats.append(post)
+                else:
+                    added += 1
+                    self.posts.append(post)
+            # Only ever needed for one rotation's worth
+            del self.repeats[:-max(self.page_limit, 1)]
+            kv_print(f"Posts in {self.source} pool", len(self.posts), level="debug")
+            kv_print(f"Recently shown posts skipped for {self.source}", repeats, level="debug")
+        return added
+
+    # Take back posts that were handed out but not used, so they are the next ones handed out
+    def put_back(self, posts: list):
+        with self.lock:
+            known = set(post.id for post in self.posts)
+            returned = [post for post in posts if post.id in self.taken_ids and post.id not in known]
+            for post in returned:
+                del self.taken_ids[post.id]
+            self.posts[:0] = returned
+
+    # Answer from the local library, which takes milliseconds rather than an API round trip
+    def fill_from_library(self, count: int, config: dict, displays: list = None):
+        if not library.enabled(config) or not config.get("library", {}).get("serve", True):
+            return
+        limit = max(count * 8, 32)
+        aspect_range = None
+        if displays:
+            # Only ask for shapes that could suit one of the displays, which the aspect index makes cheap
+            tolerance = config.get("selection", {}).get("aspect_tolerance", 0.2)
+            aspects = [display.width / display.height for display in displays]
+            aspect_range = (min(aspects) * (1 - tolerance), max(aspects) * (1 + tolerance))
+        posts = library.query(self.source, self.tags, config, limit, aspect_range)
+        if posts is not None and aspect_range is not None and len(posts) < count:
+            posts = library.query(self.source, self.tags, config, limit)
+        if posts:
+            self.add_posts(posts, config)
+
+    # Request enough pages to bring the pool up to its configured size, in parallel when it takes several
+    def fill(self, config: dict):
+        size = config.get("pool_size", self.page_limit)
+        pages = max(1, math.ceil(size / self.page_limit))
+        limit = min(size, self.page_limit)
+        logging.debug(f"Filling {self.source} post pool with {pages} page(s) of {limit} posts")
+        concurrency = max(1, min(config.get("pool_concurrency", 2), pages))
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="konawall-pool") as executor:
+            results = list(executor.map(
+                # Sources may append to the tag list they are given, so hand each request its own copy
+                lambda page: self.fetch_page(limit, list(self.tags), config, page),
+                range(1, pages + 1),
+            ))
+        posts = [post for page in results for post in page]
+        if library.enabled(config):
+            # Everything the API hands out is kept, so that later rotations can be answered locally
+            library.store(self.source, posts, config)
+        self.add_posts(posts, config)
+
+    # Runs on the refill thread
+    def refill(self, config: dict):
+        try:
+            self.fill(config)
+        except Exception as e:
+            logging.warning(f"Refilling the {self.source} post pool failed: {e}")
+
+    # Top the pool up in the background unless that is already happening
+    def refill_async(self, config: dict):
+        with self.lock:
+            if self.refill_thread is not None and self.refill_thread.is_alive():
+                return
+            self.refill_thread = threading.Thread(
+                target=self.refill,
+                args=(config,),
+                name="konawall-pool-refill",
+                daemon=True,
+            )
+            self.refill_thread.start()
+
+    # Hand out up to count posts, fetching synchronously only if the pool and the library cannot cover
+    # the request; select, if given, picks the posts to hand out from everything in the pool
+    def take(self, count: int, config: dict, select: callable = None, displays: list = None) -> list:
+        if len(self.posts) < count:
+            self.fill_from_library(count, config, displays)
+        thread = self.refill_thread
+        if len(self.posts) < count and thread is not None and thread.is_alive():
+            # A refill is already on its way, which beats starting another one
+            thread.join()
+        if len(self.posts) < count:
+            self.fill(config)
+        with self.lock:
+            if len(self.posts) < count and self.repeats:
+                # A narrow search can run out of new posts, and a repeat beats no wallpaper at all
+                logging.debug(f"Not enough new posts for {self.source}, allowing repeats")
+                missing = count - len(self.posts)
+                self.posts.extend(self.repeats[:missing])
+                del self.repeats[:missing]
+            if select is None:
+                taken = self.posts[:count]
+            else:
+                taken = select(self.posts)
+            taken_ids = set(post.id for post in taken)
+            self.posts = [post for post in self.posts if post.id not in taken_ids]
+            self.taken_ids.update(dict.fromkeys(taken_ids))
+            # Only the last few rotations' worth could still come back
+            for post_id in list(self.taken_ids)[:-max(self.page_limit, 1)]:
+                del self.taken_ids[post_id]
+            remaining = len(self.posts)
+        if remaining < config.get("pool_low_water", count * 2):
+            self.refill_async(config)
+        return taken
+
+"""
+Take posts for a rotation from the pool for a source, creating or replacing the pool as needed
+
+:param source: The name of the source
+:param fetch_page: A function taking (limit, tags, config, page) that returns a list of posts
+:param page_limit: The largest number of posts the API returns per page
+:param count: The number of posts to take
+:param tags: A list of tags to search for
+:param config: The configuration, used for pool_size, pool_low_water and pool_concurrency
+:param select: A function choosing the posts to take from a list of candidates, or None for the first count
+:param displays: The displays the posts are for, which narrows down what is looked up in the library
+:returns: A list of up to count posts
+"""
+def take_posts(source: str, fetch_page: callable, page_limit: int, count: int, tags: list, config: dict, select: callable = None, displays: list = None) -> list:
+    with pools_lock:
+        pool = pools.get(source)
+        if pool is None or pool.tags != list(tags):
+            # Posts for the old tags are no use any more
+            logging.debug(f"Creating {source} post pool for tags [{', '.join(tags)}]")
+            pool = PostPool(source, fetch_page, page_limit, tags)
+            pools[source] = pool
+    return pool.take(count, config, select, displays)
+
+"""
+Return posts that were taken but not used to the pools they came from
+
+Posts are only taken back by the pool they were taken from, so nothing from an earlier search
+ends up among the posts for new tags.
+
+:param posts: The posts
+"""
+def put_back_posts(posts: list):
+    by_source = {}
+    for post in posts:
+        by_source.setdefault(post.source, []).append(post)
+    for source, returned in by_source.items():
+        with pools_lock:
+            pool = pools.get(source)
+        if pool is not None:
+            logging.debug(f"Putting {len(returned)} unused post(s) back into the {source} pool")
+            pool.put_back(returned)
@@ -0,0 +1,85 @@
+import sys
+from konawall.custom_print import kv_print
+
+"""
+A post from any source, holding only what konawall uses
+
+Sources turn their API's responses into these as soon as they arrive, so nothing past the source
+needs to know what shape a particular API answers in. Slots keep large pools and libraries small,
+and tags are interned, since the same few tags come back on post after post.
+"""
+class Post:
+    __slots__ = ("id", "source", "width", "height", "md5", "variants", "tags", "rating", "author", "show_url", "file_size")
+
+    def __init__(
+        self,
+        id,
+        source: str,
+        width: int,
+        height: int,
+        md5: str,
+        variants: list,
+        tags,
+        rating: str,
+        author: str,
+        show_url: str,
+        file_size: int = None,
+    ):
+        self.id = id
+        self.source = sys.intern(source)
+        self.width = width
+        self.height = height
+        self.md5 = md5
+        # Renditions as (url, width, height, checksum) tuples, smallest first and the original last,
+        # leaving out ones the API did not provide
+        self.variants = tuple(tuple(variant) for variant in variants if variant[0])
+        self.tags = frozenset(sys.intern(tag) for tag in tags)
+        self.rating = sys.intern(rating) if rating else None
+        self.author = author
+        self.show_url = show_url
+        # Size of the original in bytes, when the API tells us before downloading it
+        self.file_size = file_size
+
+    @property
+    def dimensions(self) -> tuple:
+        return (self.width, self.height)
+
+    @property
+    def url(self) -> str:
+        return self.variants[-1][0]
+
+    def __repr__(self) -> str:
+        return f"Post({self.source}:{self.id}, {self.width}x{self.height})"
+
+    # Everything needed to make the post again with from_dict, in types JSON can hold
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "source": self.source,
+            "width": self.width,
+            "height": self.height,
+            "md5": self.md5,
+            "variants": self.variants,
+            "tags": sorted(self.tags),
+            "rating": self.rating,
+            "author": self.author,
+            "show_url": self.show_url,
+            "file_size": self.file_size,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**data)
+
+"""
+Give the user data about a post
+
+:param post: The post to describe
+"""
+def print_post(post: Post):
+    kv_print("Post ID", post.id)
+    kv_print("Author", post.author)
+    kv_print("Rating", post.rating)
+    kv_print("Resolution", f"{post.width}x{post.height}")
+    kv_print("Tags", " ".join(sorted(post.tags)))
+    kv_print("URL", post.url)
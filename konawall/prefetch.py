@@ -0,0 +1,83 @@
+import os
+import time
+import asyncio
+import logging
+from konawall.pipeline import fetch_rotation
+
+"""
+Identify a rotation by what it was fetched for; images picked for one monitor layout may not suit another
+
+:param source: The name of the source
+:param displays: The displays the rotation is for
+:param tags: The tags searched for
+:returns: A hashable key
+"""
+def rotation_key(source: str, displays: list, tags: list) -> tuple:
+    return (source, tuple((display.width, display.height) for display in displays), tuple(tags))
+
+"""
+Fetches the next rotation's wallpapers in the background, so that the rotation itself only has to set them
+"""
+class Prefetcher:
+    def __init__(self, rotation_loop):
+        self.rotation_loop = rotation_loop
+        self.future = None
+        self.key = None
+        self.fetched_at = None
+
+    # Start fetching a rotation on the rotation loop, unless one is already being fetched
+    def start(self, source: str, displays: list, tags: list, config: dict):
+        if self.future is not None and not self.future.done():
+            return
+        self.key = rotation_key(source, displays, tags)
+        self.fetched_at = None
+        self.future = self.rotation_loop.submit(self.fetch(source, displays, tags, config))
+        logging.debug(f"Started prefetching {len(displays)} wallpapers from {source}")
+
+    # Runs on the rotation loop
+    async def fetch(self, source: str, displays: list, tags: list, config: dict):
+        try:
+            result = await fetch_rotation(source, displays, tags, config)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Prefetching wallpapers failed, the next rotation will fetch them itself: {e}")
+            return None
+        self.fetched_at = time.monotonic()
+        logging.debug(f"Prefetched {len(displays)} wallpapers from {source}")
+        return result
+
+    # Hand over the prefetched (files, posts) if they match the request and are still fresh,
+    # otherwise return None so that the caller fetches live; runs on the rotation loop
+    async def take(self, source: str, displays: list, tags: list, max_age: float):
+        future, key = self.future, self.key
+        self.future, self.key = None, None
+        if future is None:
+            logging.debug("No prefetched wallpapers, fetching them live")
+            return None
+        if key != rotation_key(source, displays, tags):
+            logging.debug("Prefetched wallpapers were for a different request, fetching them live")
+            future.cancel()
+            return None
+        if not future.done():
+            # A fetch that is already under way will finish sooner than a new one would
+            logging.debug("Waiting for the prefetch in progress to finish")
+        try:
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Only swallow the prefetch having been cancelled, not this rotation being cancelled
+            if asyncio.current_task().cancelling():
+                raise
+            result = None
+        if result is None:
+            logging.debug("No usable prefetched wallpapers, fetching them live")
+            return None
+        if time.monotonic() - self.fetched_at > max_age:
+            logging.debug("Prefetched wallpapers are stale, fetching them live")
+            return None
+        files, posts = result
+        # The cache may have evicted them in the meantime
+        if not all(os.path.isfile(file) for file in files):
+            logging.debug("Prefetched wallpapers are missing from disk, fetching them live")
+            return None
+        return files, posts
@@ -0,0 +1,41 @@
+import time
+
+# The longest the scheduler sleeps in one go, so that a deadline that passed during suspend is noticed soon after resume
+MAX_SLEEP = 5*60
+
+"""
+A point in the future, some number of seconds after it was started
+
+Time is measured on both the monotonic and the wall clock: the monotonic clock is immune to the
+clock being changed, but stops while the machine is suspended, so whichever has seen more time pass wins.
+"""
+class Deadline:
+    def __init__(self, seconds: float):
+        self.start(seconds)
+
+    # Start counting again from now
+    def start(self, seconds: float):
+        self.seconds = seconds
+        self.started_monotonic = time.monotonic()
+        self.started_wall = time.time()
+
+    def elapsed(self) -> float:
+        return max(time.monotonic() - self.started_monotonic, time.time() - self.started_wall)
+
+    def remaining(self) -> float:
+        return max(0.0, self.seconds - self.elapsed())
+
+    def due(self) -> bool:
+        return self.remaining() <= 0
+
+"""
+Work out how long to sleep until the next thing that needs doing
+
+:param deadlines: The remaining seconds until each pending event, or None for events that are not pending
+:returns: The number of seconds to sleep for
+"""
+def sleep_for(deadlines: list) -> float:
+    pending = [remaining for remaining in deadlines if remaining is not None]
+    if not pending:
+        return MAX_SLEEP
+    return min(max(0.0, min(pending)), MAX_SLEEP)
@@ -0,0 +1,181 @@
+import logging
+from konawall.post import Post
+
+"""
+Work out how badly an image fits a display; lower is better, zero is a perfect fit
+
+:param width: The width of the image
+:param height: The height of the image
+:param display: The display the image would be shown on
+:param min_scale: How far below the display's resolution an image may be before it counts as too small
+:returns: A tuple of (too small, aspect ratio difference), which sorts good fits first
+"""
+def fit_score(width: int, height: int, display, min_scale: float) -> tuple:
+    if not width or not height:
+        # Posts without dimensions can be shown, but only as a last resort
+        return (True, float("inf"))
+    too_small = width < display.width * min_scale or height < display.height * min_scale
+    image_aspect = width / height
+    display_aspect = display.width / display.height
+    # Relative, so that 16:9 against 16:10 weighs the same as 9:16 against 10:16
+    aspect_difference = abs(image_aspect - display_aspect) / display_aspect
+    return (too_small, aspect_difference)
+
+"""
+Choose one post for each display from a list of candidates, before anything is downloaded
+
+The first candidate that is large enough and close enough in aspect ratio wins, which keeps the
+randomness of the candidates; if none qualify, the closest fit is used instead. Candidates known to be
+over the download limits are never chosen.
+
+:param posts: The candidate posts
+:param displays: The displays to choose posts for, or None to take the first count candidates
+:param config: The configuration, used for the [selection] table and the download limits
+:param count: The number of posts to choose when the displays are not known
+:returns: A list with one post per display, in display order, or fewer if there are not enough candidates
+"""
+def select_posts(posts: list, displays: list, config: dict = {}, count: int = None) -> list:
+    if not displays:
+        return [post for post in posts if within_limits(post, None, config)][:count]
+    selection_config = config.get("selection", {})
+    min_scale = selection_config.get("min_scale", 0.75)
+    aspect_tolerance = selection_config.get("aspect_tolerance", 0.2)
+    remaining = list(posts)
+    chosen = []
+    for display in displays:
+        if not remaining:
+            break
+        best_index = None
+        best_score = None
+        for i, post in enumerate(remaining):
+            if not within_limits(post, display, config):
+                continue
+            score = fit_score(post.width, post.height, display, min_scale)
+            if not score[0] and score[1] <= aspect_tolerance:
+                best_index = i
+                break
+            if best_score is None or score < best_score:
+                best_index, best_score = i, score
+        if best_index is None:
+            break
+        post = remaining.pop(best_index)
+        logging.debug(f"Selected post {post.id} ({post.width}x{post.height}) for {display.width}x{display.height} display")
+        chosen.append(post)
+    return chosen
+
+"""
+Add server-side size constraints to a tag query, when the API can take more tags
+
+:param tags: A list of tags to search for
+:param displays: The displays the posts are for
+:param config: The configuration, used for the [selection] table
+:param tag_limit: The most tags the API accepts in one search
+:returns: A new list of tags
+"""
+def size_tags(tags: list, displays: list, config: dict = {}, tag_limit: int = 6) -> list:
+    selection_config = config.get("selection", {})
+    if not displays or not selection_config.get("server_side", True):
+        return list(tags)
+    # Leave room for the "order:random" tag the sources add themselves
+    if len(tags) + 3 > tag_limit or any(tag.startswith(("width:", "height:")) for tag in tags):
+        return list(tags)
+    min_scale = selection_config.get("min_scale", 0.75)
+    # Only ask for what every display needs, the per-display choice happens locally
+    min_width = int(min(display.width for display in displays) * min_scale)
+    min_height = int(min(display.height for display in displays) * min_scale)
+    return list(tags) + [f"width:>={min_width}", f"height:>={min_height}"]
+
+"""
+Choose the smallest rendition of a post that still covers a display, with its size
+
+:param post: The post, with its variants smallest first and the original last
+:param display: The display the image is for, or None if unknown
+:param config: The configuration, used for the [selection] table
+:returns: A (url, width, height, checksum) tuple; the checksum is None for anything but the original
+"""
+def covering_variant(post: Post, display, config: dict = {}) -> tuple:
+    variants = post.variants
+    original = variants[-1]
+    if display is None or config.get("selection", {}).get("force_originals", False):
+        return original
+    for variant in variants:
+        url, width, height, checksum = variant
+        if width and height and width >= display.width and height >= display.height:
+            if url == original[0]:
+                # Some renditions are the original under another name, which can still be verified
+                break
+            return variant
+    # Nothing smaller will do
+    return original
+
+"""
+Choose the smallest rendition of a post that still covers a display
+
+:param post: The post, with its variants smallest first and the original last
+:param display: The display the image is for, or None if unknown
+:param config: The configuration, used for the [selection] table
+:returns: A (url, checksum) tuple; the checksum is None for anything but the original
+"""
+def select_variant(post: Post, display, config: dict = {}) -> tuple:
+    url, width, height, checksum = covering_variant(post, display, config)
+    if url != post.url:
+        logging.debug(f"Using {width}x{height} rendition of post {post.id} for {display.width}x{display.height} display")
+    return url, checksum
+
+"""
+Work out how many pixels an image would be decoded at for a display
+
+JPEGs are scaled down by up to eight times while decoding, as long as they still cover the display,
+see imager.load_for_display; everything else is decoded at its full size.
+
+:param url: The URL or path of the image
+:param width: The width of the image
+:param height: The height of the image
+:param display: The display the image is for, or None if unknown
+:returns: The number of pixels
+"""
+def decoded_pixels(url: str, width: int, height: int, display) -> int:
+    scale = 1
+    if display is not None and url.lower().endswith((".jpg", ".jpeg")):
+        while scale < 8 and width // (scale * 2) >= display.width and height // (scale * 2) >= display.height:
+            scale *= 2
+    return (width // scale) * (height // scale)
+
+"""
+Check whether what would be downloaded for a post is within the configured limits, as far as the API says
+
+:param post: The post
+:param display: The display the image is for, or None if unknown
+:param config: The configuration, used for download_max_bytes and max_image_pixels
+:returns: False if the post is known to be over a limit, True otherwise
+"""
+def within_limits(post: Post, display, config: dict = {}) -> bool:
+    url, width, height, checksum = covering_variant(post, display, config)
+    max_pixels = config.get("max_image_pixels", 100_000_000)
+    if width and height and decoded_pixels(url, width, height, display) > max_pixels:
+        logging.debug(f"Skipping post {post.id}, its {width}x{height} image is over the limit of {max_pixels} pixels")
+        return False
+    max_bytes = config.get("download_max_bytes", 64 * 1024 * 1024)
+    # APIs only give the size of the original
+    if url == post.url and post.file_size and post.file_size > max_bytes:
+        logging.debug(f"Skipping post {post.id}, its {post.file_size} bytes are over the limit of {max_bytes}")
+        return False
+    return True
+
+"""
+Work out what to download for each post
+
+:param posts: The posts, one per display when the displays are known
+:param displays: The displays the posts were chosen for, or None
+:param config: The configuration
+:returns: A tuple of (urls, checksums) lists, in post order
+"""
+def download_targets(posts: list, displays: list, config: dict = {}) -> tuple:
+    urls: list = []
+    checksums: list = []
+    for i, post in enumerate(posts):
+        display = displays[i] if displays and i < len(displays) else None
+        url, checksum = select_variant(post, display, config)
+        urls.append(url)
+        checksums.append(checksum)
+    return urls, checksums
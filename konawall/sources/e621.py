@@ -1,33 +1,50 @@
-import requests
+import asyncio
 import logging
 import os
-from konawall.custom_print import kv_print
+from konawall import client, metrics
+from konawall.post import Post
 from konawall.custom_errors import RequestFailed
 from konawall.module_loader import add_source
-from konawall.downloader import download_files
+from konawall.downloader import download_posts
+from konawall.pool import take_posts
+from konawall.selection import select_posts, size_tags
+
+# The most tags the API accepts in one search
+TAG_LIMIT = 40
+# The most posts the API hands out per request
+PAGE_LIMIT = 320
 
 """
-Turn a list of tags and a count into a list of URLs to download from
+Turn a list of tags and a count into a list of posts
 
-:param count: The number of images to provide download URLs for
-:param user_tags: A list of tags to search for
-:returns: A list of URLs to download from
+:param count: The number of posts to request, at most PAGE_LIMIT
+:param tags: A list of tags to search for
+:param config: The configuration
+:param page: The page of results to request
+:returns: A list of posts
 """
-def request_posts(count: int, tags: list, config) -> list:
+def request_posts(count: int, tags: list, config, page: int = 1) -> list:
     if "KONAWALL_E621_API_KEY" in os.environ:
         api_key = os.environ["KONAWALL_E621_API_KEY"]
     else:
         api_key = config["e621_api_key"]
-    logging.debug(f"request_posts() called with count={count}, tags=[{', '.join(tags)}]")
-    # Make sure we get a different result every time by using "order:random" as a tag
-    if "order:random" not in tags:
+    logging.debug(f"request_posts() called with count={count}, tags=[{', '.join(tags)}], page={page}")
+    # Make sure we get a different result every time by using "order:random" as a tag, unless asked for another order
+    if not any(tag.startswith("order:") for tag in tags):
         tags.append("order:random")
     # Tags are separated by a plus sign for this API
     tag_string: str = "+".join(tags)
+    # Another instance of the same software, or a stand-in for benchmarking, can be used instead
+    base_url: str = config.get("e621_url", "https://e621.net").rstrip("/")
     # Request URL for getting posts from the API
-    url: str = f"https://e621.net/posts.json?limit={str(count)}&tags={tag_string}"
+    url: str = f"{base_url}/posts.json?limit={str(min(count, PAGE_LIMIT))}&page={str(page)}&tags={tag_string}"
     logging.debug(f"Request URL: {url}")
-    response = requests.get(url, headers={"User-Agent": "konachan-py/alpha (by katsmew on e621)"})
+    with metrics.span("request_posts", source="e621") as span:
+        # The shared client keeps to the API's rate limit and backs off when it is asked to
+        response = client.get(url, config)
+        span.set("status", response.status_code)
+        # What came over the network, rather than the larger decompressed JSON
+        span.set("bytes", client.transferred_bytes(response))
     # Check if the request was successful
     logging.debug("Status code: " + str(response.status_code))
     # List of URLs to download
@@ -36,36 +53,66 @@ def request_posts(count: int, tags: list, config) -> list:
         # Get the JSON data from the response
         json = response.json()
         for post in json["posts"]:
-            # Give the user data about the post retrieved
-            kv_print("Post ID", post["id"])
-            kv_print("Author", post["uploader_id"])
-            kv_print("Rating", post["rating"])
-            kv_print("Resolution", f"{post['file']['width']}x{post['file']['height']}")
-            kv_print("Tags", post["tags"])
-            kv_print("URL", post["file"]["url"])
-            # Append the URL to the list
-            post["show_url"] = f"https://e621.net/posts/{post['id']}"
-            posts.append(post)
+            # Deleted and some restricted posts come without a file URL
+            if post["file"]["url"] is None:
+                continue
+            # Append the post to the list, keeping only what we use
+            posts.append(Post(
+                id=post["id"],
+                source="e621",
+                width=post["file"]["width"],
+                height=post["file"]["height"],
+                md5=post["file"]["md5"],
+                # Renditions from smallest to largest, only the original can be checked against the post MD5
+                variants=[
+                    (post["preview"]["url"], post["preview"]["width"], post["preview"]["height"], None),
+                    (post["sample"]["url"] if post["sample"]["has"] else None, post["sample"]["width"], post["sample"]["height"], None),
+                    (post["file"]["url"], post["file"]["width"], post["file"]["height"], post["file"]["md5"]),
+                ],
+                # Grouped by category in this API
+                tags=[tag for category in post["tags"].values() for tag in category],
+                rating=post["rating"],
+                author=str(post["uploader_id"]),
+                show_url=f"{base_url}/posts/{post['id']}",
+                file_size=post["file"].get("size"),
+            ))
     else:
         # Raise an exception if the request failed
-        RequestFailed(response.status_code)
+        raise RequestFailed(response.status_code, url)
     return posts
 
 """
-Download a number of images from Konachan given a list of tags and a count
+Choose posts for a rotation, without downloading them
+
+:param count: The number of posts to choose
+:param tags: A list of tags to search for
+:param config: The configuration
+:param displays: The displays to pick posts for, if known
+:param searched_for: The displays the search is sized for, when only some of them need posts, so the same pool is used
+:returns: A list of posts, one per display when the displays are known
+"""
+async def find_posts(count: int, tags: list, config, displays: list = None, searched_for: list = None) -> list:
+    searched_for = searched_for or displays
+    if searched_for:
+        # Ask the API for images that are big enough, then pick the best fit for each display locally
+        tags = size_tags(tags, searched_for, config, TAG_LIMIT)
+    # Posts the API says are too large to download are passed over here, rather than failing later
+    select = lambda candidates: select_posts(candidates, displays, config, count)
+    # Serve the posts from the local pool, which only goes to the API when it runs low
+    return await asyncio.to_thread(take_posts, "e621", request_posts, PAGE_LIMIT, count, tags, config, select, displays)
+
+"""
+Download a number of images from e621 given a list of tags and a count
 
 :param count: The number of images to download
 :param tags: A list of tags to search for
+:param config: The configuration
+:param displays: The displays to pick images for, if known
 """
 @add_source("e621")
-def handle(count: int, tags: list, config) -> list:
+async def handle(count: int, tags: list, config, displays: list = None) -> list:
     logging.debug(f"handle_e621() called with count={count}, tags=[{', '.join(tags)}]")
-    # Get a list of URLs to download
-    posts: list = request_posts(count, tags, config)
-    urls: list = []
-    # Download the images
-    for post in posts:
-        urls.append(post["file"]["url"])
-    files = download_files(urls)
-    # Return the downloaded files
-    return files, posts
+    posts: list = await find_posts(count, tags, config, displays)
+    # Posts that fail to download are swapped for others from the pool, for the same display
+    replace = lambda count, targets: find_posts(count, tags, config, targets, displays)
+    return await download_posts(posts, displays, config, replace)
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import pathlib
+import threading
+from PIL import Image
+from konawall import cache, history
+from konawall.custom_print import kv_print
+from konawall.module_loader import add_source
+from konawall.post import Post
+from konawall.selection import select_posts
+
+INDEX_FILE = "local-index.json"
+EXTENSIONS = [".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff"]
+
+# Paths to [mtime_ns, size, width, height] lists, loaded from and saved to INDEX_FILE
+global index
+index = None
+scanned_at = 0
+# The directories the last scan covered
+scanned_directories = None
+index_lock = threading.Lock()
+
+"""
+Read the dimensions of an image from its header, without decoding it
+
+:param path: The path to the image
+:returns: A (width, height) tuple, or (0, 0) if it cannot be read
+"""
+def image_size(path: str) -> tuple:
+    try:
+        # Opening is lazy, the pixel data is only read when something asks for it
+        with Image.open(path) as image:
+            return image.size
+    except Exception as e:
+        logging.debug(f"Could not read the size of {path}: {e}")
+        return (0, 0)
+
+"""
+Find every image under a directory, with the stat results scandir already has
+
+:param path: The directory
+:param extensions: The file extensions to count as images, in lower case
+:returns: A generator of os.DirEntry objects
+"""
+def walk_images(path: str, extensions: list):
+    try:
+        entries = list(os.scandir(path))
+    except OSError as e:
+        logging.warning(f"Could not read {path}: {e}")
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_images(entry.path, extensions)
+        elif os.path.splitext(entry.name)[1].lower() in extensions:
+            yield entry
+
+"""
+Bring the index of the configured directories up to date, only reading images that are new or changed
+
+:param config: The configuration, used for the [local] table
+:returns: The index
+"""
+def scan(config: dict = {}) -> dict:
+    global index, scanned_at, scanned_directories
+    local_config = config.get("local", {})
+    index_path = os.path.join(cache.cache_dir(config), INDEX_FILE)
+    with index_lock:
+        if index is None:
+            try:
+                with open(index_path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                index = {}
+        directories = local_config.get("directories", [])
+        # Listing a large library still takes a moment, so do not do it every rotation
+        recent = scanned_at and time.monotonic() - scanned_at < local_config.get("rescan_interval", 300)
+        if recent and directories == scanned_directories:
+            return index
+        start = time.perf_counter()
+        extensions = [extension.lower() for extension in local_config.get("extensions", EXTENSIONS)]
+        updated = {}
+        read = 0
+        for directory in directories:
+            for entry in walk_images(os.path.expanduser(directory), extensions):
+                stat = entry.stat()
+                known = index.get(entry.path)
+                if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+                    updated[entry.path] = known
+                    continue
+                updated[entry.path] = [stat.st_mtime_ns, stat.st_size, *image_size(entry.path)]
+                read += 1
+        changed = read or len(updated) != len(index)
+        index = updated
+        scanned_at = time.monotonic()
+        scanned_directories = directories
+        kv_print("Local images", f"{len(index)} indexed, {read} read, in {time.perf_counter() - start:.3f}s", level="debug")
+        if changed:
+            part_path = index_path + cache.PART_SUFFIX
+            with open(part_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, separators=(",", ":"))
+            os.replace(part_path, index_path)
+        return index
+
+"""
+Describe a local image the way the other sources describe their posts
+
+:param path: The path to the image
+:param width: The width of the image
+:param height: The height of the image
+:returns: A post
+"""
+def local_post(path: str, width: int, height: int) -> Post:
+    return Post(
+        id=path,
+        source="local",
+        width=width,
+        height=height,
+        md5=None,
+        variants=[(path, width, height, None)],
+        tags=[],
+        rating=None,
+        author=None,
+        show_url=pathlib.Path(path).as_uri(),
+    )
+
+"""
+Choose images from the configured directories, without touching the network
+
+:param count: The number of images to choose
+:param tags: Ignored, local images have no tags
+:param config: The configuration, used for the [local] table
+:param displays: The displays to pick images for, if known
+:returns: A list of posts, whose URLs are the paths to the images
+"""
+async def find_posts(count: int, tags: list, config, displays: list = None) -> list:
+    entries = await asyncio.to_thread(scan, config)
+    usable = [(path, entry[2], entry[3]) for path, entry in entries.items() if entry[2] and entry[3]]
+    # Enough random candidates for the display-aware selection to find good fits among
+    candidates = [local_post(*entry) for entry in random.sample(usable, min(len(usable), max(count * 50, 200)))]
+    shown = history.get_index(config)
+    if shown is not None:
+        fresh = [post for post in candidates if not shown.is_recent(post)]
+        # A small library can run out of images that have not been shown recently
+        if len(fresh) >= count:
+            candidates = fresh
+    if displays:
+        return select_posts(candidates, displays, config)
+    return candidates[:count]
+
+"""
+Use images from the configured directories as they are
+
+:param count: The number of images to choose
+:param tags: Ignored, local images have no tags
+:param config: The configuration, used for the [local] table
+:param displays: The displays to pick images for, if known
+"""
+@add_source("local")
+async def handle(count: int, tags: list, config, displays: list = None) -> list:
+    logging.debug(f"handle_local() called with count={count}")
+    posts = await find_posts(count, tags, config, displays)
+    for post in posts:
+        kv_print("Local image", post.id)
+    return [post.url for post in posts], posts
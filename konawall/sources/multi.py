@@ -0,0 +1,169 @@
+import os
+import sys
+import asyncio
+import logging
+from konawall.custom_print import kv_print
+from konawall.downloader import download_posts
+from konawall.module_loader import add_source, source_handlers
+from konawall.pipeline import call_handler
+from konawall.pool import put_back_posts
+
+"""
+Find the find_posts function of a source, for sources that can look up posts without downloading them
+
+:param name: The name of the source
+:returns: The function, or None if the source only has a handler
+"""
+def post_finder(name: str) -> callable:
+    return getattr(sys.modules.get(source_handlers[name].__module__), "find_posts", None)
+
+"""
+Start asking a source for posts, only for the posts where it can, so that nothing is downloaded yet
+
+Sources with a find_posts function, like the ones shipped with konawall, are only asked for posts;
+any other source runs its whole handler, and hands back files it has already downloaded.
+
+:param name: The name of the source
+:param count: The number of posts to ask for
+:param tags: A list of tags to search for
+:param config: The configuration
+:param displays: The displays to pick posts for, if known
+:returns: A task resolving to a list of (file, post) tuples, with None for files not downloaded yet
+"""
+def ask_source(name: str, count: int, tags: list, config, displays: list) -> asyncio.Task:
+    handler = source_handlers[name]
+    find_posts = post_finder(name)
+    if find_posts is not None:
+        async def query() -> list:
+            # Posts from local sources are files already
+            return [
+                (post.url if os.path.isfile(post.url) else None, post)
+                for post in await find_posts(count, tags, config, displays)
+            ]
+        task = asyncio.create_task(query(), name=name)
+        task.downloads = False
+    else:
+        async def run() -> list:
+            files, posts = await call_handler(handler, count, tags, config=config, displays=displays)
+            return list(zip(files, posts))
+        task = asyncio.create_task(run(), name=name)
+        task.downloads = True
+    return task
+
+"""
+Hand what a source found back to it once it finishes, for a source that was not waited for
+
+:param task: The task asking the source
+"""
+def put_back_when_done(task: asyncio.Task):
+    if task.cancelled() or task.exception() is not None:
+        return
+    put_back_posts([post for _, post in task.result()])
+
+"""
+Ask several sources for wallpapers at once, and use whichever answer first
+
+Each display gets a post from the first source to come back with one for it; once every display
+has one, the wallpapers are downloaded, once. With a hedge delay, the next source is only asked once
+the ones asked so far have taken that long, have failed or came up short. Sources still searching
+are left to finish, and their posts are put back in their pools for later rotations.
+
+:param count: The number of images to download
+:param tags: A list of tags to search for, unless [multi.tags] has a list for a source
+:param config: The configuration, used for the [multi] table
+:param displays: The displays to pick images for, if known
+"""
+@add_source("multi")
+async def handle(count: int, tags: list, config, displays: list = None) -> list:
+    multi_config = config.get("multi", {})
+    waiting = [
+        name for name in multi_config.get("sources", ["konachan", "e621"])
+        # Asking ourselves would never end
+        if name != "multi"
+    ]
+    hedge_delay = multi_config.get("hedge_delay", 0)
+    source_tags = multi_config.get("tags", {})
+    logging.debug(f"handle_multi() called with count={count}, tags=[{', '.join(tags)}], sources=[{', '.join(waiting)}]")
+    chosen = [None] * count
+    pending = set()
+    errors = []
+    # Sources that came back with posts without downloading them, which can stand in for failed downloads
+    answered = []
+
+    # Start asking the next source that has not been asked yet
+    def start_next():
+        while waiting:
+            name = waiting.pop(0)
+            if name not in source_handlers:
+                logging.warning(f"Source {name} is not available, skipping it")
+                continue
+            pending.add(ask_source(name, count, list(source_tags.get(name, tags)), config, displays))
+            return
+
+    start_next()
+    if not hedge_delay:
+        while waiting:
+            start_next()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=hedge_delay if waiting else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                logging.debug("Sources are slow to answer, asking another one as well")
+                start_next()
+                continue
+            for task in done:
+                pending.discard(task)
+                try:
+                    found = task.result()
+                except Exception as e:
+                    logging.warning(f"Source {task.get_name()} failed: {e!r}")
+                    errors.append(e)
+                    continue
+                kv_print(f"Posts from {task.get_name()}", len(found), level="debug")
+                if not task.downloads:
+                    answered.append(task.get_name())
+                unused = []
+                for i, (file, post) in enumerate(found):
+                    if i < count and chosen[i] is None:
+                        chosen[i] = (file, post)
+                    else:
+                        unused.append(post)
+                put_back_posts(unused)
+            if all(chosen):
+                break
+            # Something failed or came up short, there is no point waiting out the hedge delay
+            start_next()
+    finally:
+        for task in pending:
+            if task.downloads:
+                # A whole handler may be downloading, which is only worth stopping
+                task.cancel()
+            else:
+                # Looking up posts is cheap to let finish, and the posts are still good for later
+                task.add_done_callback(put_back_when_done)
+    # Slots no source had a post for are left out, along with their displays
+    slots = [i for i, entry in enumerate(chosen) if entry is not None]
+    if not slots and errors:
+        raise errors[0]
+    # Download only what was chosen, and only what the source has not downloaded already
+    missing = [i for i in slots if chosen[i][0] is None]
+    replace = None
+    if answered:
+        name = answered[0]
+        # Posts that fail to download are swapped for others from the source that answered first
+        replace = lambda count, targets: call_handler(
+            post_finder(name), count, list(source_tags.get(name, tags)), config, targets, searched_for=displays,
+        )
+    files, posts = await download_posts(
+        [chosen[i][1] for i in missing],
+        [displays[i] for i in missing] if displays else None,
+        config,
+        replace,
+    )
+    for i, file, post in zip(missing, files, posts):
+        chosen[i] = (file, post)
+    return [chosen[i][0] for i in slots], [chosen[i][1] for i in slots]
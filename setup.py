@@ -21,6 +21,7 @@ setup(
     entry_points = {
         "console_scripts": [
             "konawall = konawall.gui:main",
+            "konawall-harvest = konawall.harvest:main",
         ],
     },
 )
\ No newline at end of file
@@ -0,0 +1,94 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from PIL import Image
+from konawall import downloader
+from konawall.custom_errors import DownloadFailed, ImageTooLarge, RequestFailed
+from konawall.post import Post
+from konawall.selection import select_posts
+
+@pytest.fixture
+def config(tmp_path):
+    return {"cache_dir": str(tmp_path)}
+
+@pytest.fixture
+def displays():
+    return [
+        SimpleNamespace(x=0, y=0, width=1920, height=1080),
+        SimpleNamespace(x=1920, y=0, width=1920, height=1080),
+    ]
+
+@pytest.fixture
+def broken(monkeypatch, tmp_path):
+    # URLs that fail, standing in for missing, oversized and corrupt images
+    broken = {}
+    def download_file(url: str, checksum: str = None, config: dict = {}) -> str:
+        if url in broken:
+            raise broken[url]
+        path = tmp_path / url.rsplit("/", 1)[-1]
+        Image.new("RGB", (128, 72) if "large" in url else (64, 36)).save(path, "PNG")
+        return str(path)
+    monkeypatch.setattr(downloader, "download_file", download_file)
+    return broken
+
+def sample_post(post_id: int, file_size: int = None) -> Post:
+    return Post(
+        id=post_id,
+        source="sample",
+        width=1920,
+        height=1080,
+        md5=None,
+        variants=[(f"https://example.com/{post_id}.jpg", 1920, 1080, None)],
+        tags=[],
+        rating="s",
+        author=None,
+        show_url=f"https://example.com/post/{post_id}",
+        file_size=file_size,
+    )
+
+def test_failed_post_is_replaced_for_its_display(config, displays, broken):
+    broken["https://example.com/1.jpg"] = RequestFailed(404, "https://example.com/1.jpg")
+    asked = []
+    async def replace(count: int, targets: list) -> list:
+        asked.append((count, targets))
+        return [sample_post(2)]
+    files, posts = asyncio.run(downloader.download_posts([sample_post(0), sample_post(1)], displays, config, replace))
+    assert [file.rsplit("/", 1)[-1] for file in files] == ["0.jpg", "2.jpg"]
+    assert [post.id for post in posts] == [0, 2]
+    assert asked == [(1, [displays[1]])]
+
+def test_error_is_raised_when_nothing_replaces_the_post(config, displays, broken):
+    error = DownloadFailed("https://example.com/1.jpg", "checksum mismatch")
+    broken["https://example.com/1.jpg"] = error
+    async def replace(count: int, targets: list) -> list:
+        return []
+    with pytest.raises(DownloadFailed) as raised:
+        asyncio.run(downloader.download_posts([sample_post(0), sample_post(1)], displays, config, replace))
+    assert raised.value is error
+
+def test_image_over_the_pixel_limit_is_replaced(config, displays, broken):
+    # Found to be too large only from the downloaded header, as the API gave no dimensions
+    config["max_image_pixels"] = 64 * 36
+    large = sample_post(0)
+    large.variants = (("https://example.com/large.png", None, None, None),)
+    async def replace(count: int, targets: list) -> list:
+        return [sample_post(1)]
+    files, posts = asyncio.run(downloader.download_posts([large], displays, config, replace))
+    assert [post.id for post in posts] == [1]
+    with pytest.raises(ImageTooLarge):
+        asyncio.run(downloader.download_posts([large], displays, config))
+
+def test_selection_skips_posts_over_the_size_limit(displays):
+    config = {"download_max_bytes": 1000}
+    posts = [sample_post(0, file_size=2000), sample_post(1, file_size=500), sample_post(2)]
+    assert [post.id for post in select_posts(posts, displays, config)] == [1, 2]
+    assert [post.id for post in select_posts(posts, None, config, 1)] == [1]
+
+def test_selection_skips_posts_over_the_pixel_limit(displays):
+    config = {"max_image_pixels": 1920 * 1080 * 4}
+    large = sample_post(0)
+    large.variants = (("https://example.com/0.png", 3840, 2160 + 1, None),)
+    # The same size as a JPEG is decoded at a quarter of that for these displays
+    jpeg = sample_post(1)
+    jpeg.variants = (("https://example.com/1.jpg", 3840, 2160 + 1, None),)
+    assert [post.id for post in select_posts([large, jpeg, sample_post(2)], displays, config)] == [1, 2]
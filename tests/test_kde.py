@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+from types import SimpleNamespace
+import pytest
+from PIL import Image
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+if shutil.which("dbus-daemon") is None:
+    pytest.skip("dbus-daemon is not installed", allow_module_level=True)
+
+from konawall.environments import kde
+
+# A stand-in for Plasma's shell, logging every script it is asked to evaluate and who asked
+STUB_SERVICE = """
+import sys
+import json
+import dbus
+import dbus.service
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+class PlasmaShell(dbus.service.Object):
+    @dbus.service.method("org.kde.PlasmaShell", in_signature="s", out_signature="s", sender_keyword="sender")
+    def evaluateScript(self, script, sender=None):
+        with open(sys.argv[1], "a") as f:
+            f.write(json.dumps({"sender": str(sender), "script": str(script)}) + "\\n")
+        return ""
+
+dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+bus = dbus.SessionBus()
+name = dbus.service.BusName("org.kde.plasmashell", bus)
+PlasmaShell(bus, "/PlasmaShell")
+GLib.MainLoop().run()
+"""
+
+"""
+Wait until the stand-in service owns its name on the bus, or no longer does
+
+:param owned: Whether to wait for the name to be owned or released
+"""
+def wait_for_plasma(owned: bool = True):
+    bus = dbus.SessionBus(private=True)
+    try:
+        deadline = time.monotonic() + 10
+        while bus.name_has_owner("org.kde.plasmashell") != owned:
+            if time.monotonic() > deadline:
+                raise TimeoutError("The stand-in Plasma service did not come up or go away")
+            time.sleep(0.05)
+    finally:
+        bus.close()
+
+class Plasma:
+    def __init__(self, tmp_path):
+        self.script_path = tmp_path / "plasmashell.py"
+        self.script_path.write_text(STUB_SERVICE)
+        self.log_path = tmp_path / "scripts.jsonl"
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, str(self.script_path), str(self.log_path)])
+        wait_for_plasma(owned=True)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        wait_for_plasma(owned=False)
+
+    # The scripts evaluated so far, as {"sender": ..., "script": ...} dicts
+    def calls(self) -> list:
+        if not self.log_path.exists():
+            return []
+        return [json.loads(line) for line in self.log_path.read_text().splitlines()]
+
+@pytest.fixture
+def session_bus(monkeypatch):
+    daemon = subprocess.Popen(
+        ["dbus-daemon", "--session", "--nofork", "--print-address"],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    address = daemon.stdout.readline().strip()
+    monkeypatch.setenv("DBUS_SESSION_BUS_ADDRESS", address)
+    yield address
+    daemon.terminate()
+    daemon.wait()
+
+@pytest.fixture
+def plasma(session_bus, tmp_path):
+    plasma = Plasma(tmp_path)
+    plasma.start()
+    yield plasma
+    if kde.bus is not None:
+        kde.bus.close()
+    kde.bus = None
+    kde.plasma = None
+    kde.current_images.clear()
+    if plasma.process.poll() is None:
+        plasma.stop()
+
+@pytest.fixture
+def config(tmp_path):
+    return {"cache_dir": str(tmp_path / "cache")}
+
+@pytest.fixture
+def displays():
+    return [
+        SimpleNamespace(x=0, y=0, width=64, height=48),
+        SimpleNamespace(x=64, y=0, width=64, height=48),
+    ]
+
+@pytest.fixture
+def images(tmp_path):
+    paths = []
+    for i, colour in enumerate(["red", "green", "blue", "white"]):
+        path = tmp_path / f"{i}.png"
+        Image.new("RGB", (128, 96), colour).save(path)
+        paths.append(str(path))
+    return paths
+
+def test_connection_is_reused(plasma, config, displays, images):
+    kde.set_wallpapers(images[0:2], displays, config)
+    first_bus = kde.bus
+    kde.set_wallpapers(images[2:4], displays, config)
+    calls = plasma.calls()
+    assert len(calls) == 2
+    # Both scripts came in over the same connection
+    assert calls[0]["sender"] == calls[1]["sender"]
+    assert kde.bus is first_bus
+
+def test_reconnects_after_service_restart(plasma, config, displays, images):
+    kde.set_wallpapers(images[0:2], displays, config)
+    plasma.stop()
+    plasma.start()
+    kde.set_wallpapers(images[2:4], displays, config)
+    calls = plasma.calls()
+    assert len(calls) == 2
+    assert calls[0]["sender"] != calls[1]["sender"]
+
+def test_one_changed_desktop_uses_script_one(plasma, config, displays, images):
+    kde.set_wallpapers(images[0:2], displays, config)
+    kde.set_wallpapers([images[0], images[2]], displays, config)
+    calls = plasma.calls()
+    assert len(calls) == 2
+    assert "IMAGE_LIST" not in calls[0]["script"] and "const imageList" in calls[0]["script"]
+    assert "const imageList" not in calls[1]["script"]
+    assert "setWallpaper(getDesktops()[1]," in calls[1]["script"]
+    # Only the wallpaper for the changed desktop is sent
+    assert os.path.basename(kde.current_images[1]) in calls[1]["script"]
+    assert os.path.basename(kde.current_images[0]) not in calls[1]["script"]
+
+def test_renditions_follow_the_desktop_order(plasma, config, images):
+    # Listed right to left, while the script hands images to desktops from left to right
+    displays = [
+        SimpleNamespace(x=64, y=0, width=64, height=48),
+        SimpleNamespace(x=0, y=0, width=32, height=24),
+    ]
+    kde.set_wallpapers(images[0:2], displays, config)
+    script = plasma.calls()[0]["script"]
+    image_list = json.loads(script.split("const imageList = ")[1].split(";")[0])
+    with Image.open(image_list[0]) as left, Image.open(image_list[1]) as right:
+        assert left.size == (32, 24)
+        assert right.size == (64, 48)
@@ -0,0 +1,65 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from konawall.module_loader import add_environment, add_source, environment_handlers, source_handlers
+from konawall.pipeline import rotate
+from konawall.post import Post
+
+@pytest.fixture
+def config(tmp_path):
+    return {"cache_dir": str(tmp_path)}
+
+@pytest.fixture
+def displays():
+    return [SimpleNamespace(x=0, y=0, width=1920, height=1080)]
+
+@pytest.fixture
+def handlers():
+    calls = {}
+    yield calls
+    del source_handlers["baseline"]
+    del environment_handlers["baseline_setter"]
+
+def sample_post(post_id: int) -> Post:
+    return Post(
+        id=post_id,
+        source="baseline",
+        width=1920,
+        height=1080,
+        md5=None,
+        variants=[(f"https://example.com/{post_id}.jpg", 1920, 1080, None)],
+        tags=[],
+        rating="s",
+        author=None,
+        show_url=f"https://example.com/post/{post_id}",
+    )
+
+def test_rotate_with_baseline_handler_signatures(handlers, config, displays):
+    # The signatures handlers had before displays and config were passed to them
+    @add_source("baseline")
+    def handle(count: int, tags: list, config) -> list:
+        handlers["source"] = (count, tags)
+        return [f"/tmp/{i}.jpg" for i in range(count)], [sample_post(i) for i in range(count)]
+
+    @add_environment("baseline_setter")
+    def set_wallpapers(files: list, displays: list):
+        handlers["setter"] = (files, displays)
+
+    files, posts = asyncio.run(rotate("baseline", "baseline", displays, ["tag"], config))
+    assert files == ["/tmp/0.jpg"]
+    assert handlers["source"] == (1, ["tag"])
+    assert handlers["setter"] == (["/tmp/0.jpg"], displays)
+
+def test_rotate_passes_displays_and_config_when_taken(handlers, config, displays):
+    @add_source("baseline")
+    async def handle(count: int, tags: list, config, displays: list = None) -> list:
+        handlers["source"] = (config, displays)
+        return ["/tmp/0.jpg"], [sample_post(0)]
+
+    @add_environment("baseline_setter")
+    async def set_wallpapers(files: list, displays: list, config: dict = {}):
+        handlers["setter"] = config
+
+    asyncio.run(rotate("baseline", "baseline", displays, [], config))
+    assert handlers["source"] == (config, displays)
+    assert handlers["setter"] is config